@@ -0,0 +1,152 @@
+import hashlib
+import os
+import time
+import zipfile
+
+import numpy as np
+
+# Bump this whenever the way cached values are computed changes so stale entries are ignored
+VERSION = 2
+
+def default_path():
+    return os.environ.get("ALLDIGITALRADIO_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "alldigitalradio"))
+
+class PatternCache(object):
+    """
+    A two level (in-process dict + on-disk .npz files) cache for precomputed arrays
+    such as oscillator patterns. Entries are keyed by any tuple of parameters with a
+    stable repr(), and the on-disk part is kept under max_bytes by evicting the least
+    recently used files. Without a path, ALLDIGITALRADIO_CACHE (looked up whenever the
+    disk is used, so it can be changed after import) or ~/.cache/alldigitalradio is used.
+    Set path (or ALLDIGITALRADIO_CACHE) to "" to only cache within the current process.
+    With verbose, every lookup is printed; otherwise hits and misses are only counted.
+    """
+    def __init__(self, path=None, max_bytes=256*1024*1024, verbose=False):
+        self.configured_path = path
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        self.memo = {}
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def path(self):
+        return (default_path() if self.configured_path is None else self.configured_path) or None
+
+    def filename(self, key):
+        digest = hashlib.sha1(repr((VERSION,) + tuple(key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + ".npz")
+
+    def get(self, key):
+        key = (VERSION,) + tuple(key)
+        if key in self.memo:
+            self.hits += 1
+            self.report("hit", key)
+            return self.memo[key]
+
+        if self.path is not None:
+            filename = self.filename(key[1:])
+            try:
+                with np.load(filename) as f:
+                    entry = {k: f[k] for k in f.files}
+                self.touch(filename)
+            except (OSError, ValueError, zipfile.BadZipFile):
+                pass
+            else:
+                self.hits += 1
+                self.disk_hits += 1
+                self.report("disk hit", key)
+                self.memo[key] = entry
+                return entry
+
+        self.misses += 1
+        self.report("miss", key)
+        return None
+
+    def put(self, key, **entry):
+        self.memo[(VERSION,) + tuple(key)] = entry
+        if self.path is None:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        filename = self.filename(key)
+        tmp = "{}.{}.tmp.npz".format(filename[:-4], os.getpid())
+        np.savez(tmp, **entry)
+        os.replace(tmp, filename)
+        self.touch(filename)
+        self.evict()
+
+    def touch(self, filename):
+        # Filesystem timestamps can be coarser than the time between puts, so set them explicitly
+        now = time.time_ns()
+        os.utime(filename, ns=(now, now))
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".npz") and ".tmp." not in name:
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    # Evicted or replaced by another process since listdir()
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.memo = {}
+        if self.path is not None and os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith(".npz"):
+                    os.remove(os.path.join(self.path, name))
+
+    def report(self, what, key):
+        if self.verbose:
+            print("Pattern cache {} for {} ({} hits, {} misses)".format(what, key[1:], self.hits, self.misses))
+
+pattern_cache = PatternCache()
+
+def test_pattern_cache(tmp_path):
+    cache = PatternCache(path=str(tmp_path), max_bytes=10*1024)
+    key = (5e9, 2.4e9, 100.0, 20, 0.0)
+
+    assert cache.get(key) is None
+    cache.put(key, pattern=np.arange(10, dtype=np.uint32), realized_frequency=np.float64(2.4e9))
+    assert (cache.get(key)['pattern'] == np.arange(10)).all()
+    assert (cache.hits, cache.disk_hits, cache.misses) == (1, 0, 1)
+
+    # A fresh cache pointed at the same directory finds it on disk
+    fresh = PatternCache(path=str(tmp_path))
+    assert fresh.get(key)['realized_frequency'] == 2.4e9
+    assert (fresh.hits, fresh.disk_hits, fresh.misses) == (1, 1, 0)
+
+    # Filling the cache past max_bytes evicts the oldest entries
+    for i in range(20):
+        cache.put((i,), pattern=np.zeros(256, dtype=np.uint32))
+    files = os.listdir(str(tmp_path))
+    assert sum(os.path.getsize(os.path.join(str(tmp_path), f)) for f in files) <= 10*1024
+    assert os.path.basename(cache.filename((19,))) in files
+    assert os.path.basename(cache.filename((0,))) not in files
+
+    # A corrupt file is just a miss
+    with open(cache.filename((19,)), 'wb') as f:
+        f.write(b"not a zip file")
+    assert PatternCache(path=str(tmp_path)).get((19,)) is None
+
+def test_pattern_cache_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("ALLDIGITALRADIO_CACHE", str(tmp_path))
+    assert pattern_cache.path == PatternCache().path == str(tmp_path)
+    monkeypatch.setenv("ALLDIGITALRADIO_CACHE", "")
+    assert PatternCache().path is None and PatternCache(path="").path is None
@@ -1,42 +1,102 @@
+from math import ceil, comb, floor, log2
+
 from nmigen import *
+import numpy as np
+
+from alldigitalradio.util import clock_enabled
+
+def saturate(value, max_val):
+    """value clamped to [-max_val, max_val]"""
+    return Mux(value > max_val, max_val, Mux(value < -max_val, -max_val, value))
+
+def wrap(values, signal):
+    """values as they'd end up when assigned to a signed signal, i.e. two's complement wrapped"""
+    half = 1 << (len(signal) - 1)
+    return (values + half) % (2*half) - half
+
+def model_samples(block, samples, input=None):
+    """What the input samples of a RunningBoxcarFilter or SimpleDecimator become internally"""
+    samples = wrap(np.asarray(samples).astype(np.int64), block.input if input is None else input)
+    if block.saturate:
+        return np.clip(samples, -block.max_val, block.max_val)
+    return wrap(samples, Signal(range(-block.max_val, block.max_val + 1)))
+
+def boxcar_limits(max_val, filter_width):
+    """(max_val, max_output) for a boxcar filter, which without a max_val are the limits
+       of the 8 bit input and 14 bit sum it had before widths were derived from it"""
+    if max_val is None:
+        return 2**7 - 1, 2**13 - 1
+    return max_val, max_val*filter_width
 
 class RunningBoxcarFilter(Elaboratable):
-    def __init__(self, filter_width, max_val=20, domain="sync"):
+    """
+    The sum of the last filter_width inputs (as of the clock before), with the inputs kept
+    in a memory to subtract them back off. Every width follows from max_val, the largest
+    input magnitude, so the running sum is exactly wide enough for max_output =
+    max_val*filter_width. The input can be made wider with input_width, in which case
+    saturate=True clamps it to +/-max_val first (otherwise it has to stay in range or the
+    sum can overflow). Without a max_val, the input is 8 bits and the sum 14 bits as they
+    always were.
+
+    Inputs are only taken on clocks with enable high, and output_valid is high whenever
+    output has just been updated (see clock_enabled()).
+    """
+    def __init__(self, filter_width, max_val=None, domain="sync", input_width=None, saturate=False):
+        if filter_width < 3:
+            raise ValueError("RunningBoxcarFilter needs a filter_width of at least 3, got {}".format(filter_width))
         self.domain = domain
-        self.memory = Memory(width=8, depth=filter_width, init=[0]*filter_width)
-        self.input = Signal(signed(8))
-        self.output = Signal(signed(14))
         self.filter_width = filter_width
-        self.running_sum = Signal(signed(14))
+        self.max_val, self.max_output = boxcar_limits(max_val, filter_width)
+        max_val = self.max_val
+        self.saturate = saturate
 
-        self.debug = Signal(signed(14))
-        self.debug1 = Signal(signed(14))
-        self.debug2 = Signal(signed(14))
+        sample = Shape.cast(range(-max_val, max_val + 1))
+        self.input = Signal(signed(input_width) if input_width else sample)
+        self.output = Signal(range(-self.max_output, self.max_output + 1))
+        self.memory = Memory(width=sample.width, depth=filter_width, init=[0]*filter_width)
+        self.running_sum = Signal.like(self.output)
+
+        self.debug = Signal.like(self.output)
+        self.debug1 = Signal(sample)
+        self.debug2 = Signal(sample)
         self.debugen = Signal()
 
-        self.memout = Signal(signed(8))
-        self.addr = Signal(12)
+        self.memout = Signal(sample)
+        self.addr = Signal(range(filter_width))
+
+        self.enable = Signal(reset=1)
+        self.output_valid = Signal()
+
+    def inputs(self):
+        return [self.input]
+
+    def outputs(self):
+        return [self.output]
 
     def elaborate(self, platform):
         m = Module()
 
-        m.submodules.rport = rport = self.memory.read_port(domain=self.domain)
+        m.submodules.rport = rport = self.memory.read_port(domain=self.domain, transparent=False)
         m.submodules.wport = wport = self.memory.write_port(domain=self.domain)
 
         running_sum = self.running_sum
 
         domain = getattr(m.d, self.domain)
 
-        addr = Signal(range(self.filter_width))
+        sample = Signal.like(self.memout)
+        m.d.comb += sample.eq(saturate(self.input, self.max_val) if self.saturate else self.input)
 
-        domain += [
-            rport.addr.eq(addr + 1),
-            wport.addr.eq(addr), # TODO: handle underflow
-            wport.data.eq(self.input),
-            self.memout.eq(rport.data),
+        addr = self.addr
+
+        # The sample written filter_width cycles ago is read two addresses ahead, to make
+        # up for the read port and memout registers, so that memout is exactly it
+        domain += self.memout.eq(rport.data)
+        m.d.comb += [
+            rport.addr.eq(Mux(addr >= self.filter_width - 2, addr + 2 - self.filter_width, addr + 2)),
+            wport.addr.eq(addr),
+            wport.data.eq(sample),
         ]
 
-            # self.addr.eq(addr),
         m.d.comb += [
             wport.en.eq(1),
             self.output.eq(running_sum)
@@ -45,15 +105,15 @@ class RunningBoxcarFilter(Elaboratable):
         cycles = Signal(range(self.filter_width + 1))
         with m.If(cycles <= self.filter_width):
             domain += cycles.eq(cycles + 1)
-            domain += running_sum.eq(running_sum + self.input)
+            domain += running_sum.eq(running_sum + sample)
         with m.Else():
             pass
 
-        m.d.comb += self.debug.eq(self.input - self.memout.as_signed())
+        m.d.comb += self.debug.eq(sample - self.memout.as_signed())
 
-        domain += running_sum.eq(running_sum + self.input - self.memout.as_signed())
+        domain += running_sum.eq(running_sum + sample - self.memout.as_signed())
 
-        domain += self.debug1.eq(self.input)
+        domain += self.debug1.eq(sample)
         domain += self.debug2.eq(self.memout.as_signed())
 
         with m.If(addr == self.filter_width - 1):
@@ -61,33 +121,610 @@ class RunningBoxcarFilter(Elaboratable):
         with m.Else():
             domain += addr.eq(addr + 1)
 
-        return m
+        return clock_enabled(m, self.domain, self.enable, self.output_valid, self.enable)
+
+    def model(self, samples):
+        """output for each input sample, as make_callable returns it (so from the clock
+           before): a plain sum of the filter_width samples before it. The memory starts
+           out zeroed, so the first filter_width sums need no special casing, and the
+           wraparound of the running sum adding and subtracting is exactly two's complement."""
+        return boxcar_model(self, samples, self.input, self.output)
+
+def boxcar_model(block, samples, input, output):
+    samples = model_samples(block, samples, input)
+    running = np.concatenate([np.zeros(1, np.int64), np.cumsum(samples)])
+    delayed = np.concatenate([np.zeros(block.filter_width, np.int64), running])
+    return wrap(running[:len(samples)] - delayed[:len(samples)], output)
+
+class IQBoxcarFilter(Elaboratable):
+    """
+    A pair of RunningBoxcarFilters, for the I and Q outputs of a mixer, that keep both
+    channels' samples side by side in one memory twice as wide and so share the memory,
+    its address counter and its read and write ports. Each output is bit for bit what a
+    RunningBoxcarFilter with the same parameters would give.
+    """
+    def __init__(self, filter_width, max_val=None, domain="sync", input_width=None, saturate=False):
+        if filter_width < 3:
+            raise ValueError("IQBoxcarFilter needs a filter_width of at least 3, got {}".format(filter_width))
+        self.domain = domain
+        self.filter_width = filter_width
+        self.max_val, self.max_output = boxcar_limits(max_val, filter_width)
+        max_val = self.max_val
+        self.saturate = saturate
+
+        sample = Shape.cast(range(-max_val, max_val + 1))
+        self.inputI = Signal(signed(input_width) if input_width else sample)
+        self.inputQ = Signal.like(self.inputI)
+        self.outputI = Signal(range(-self.max_output, self.max_output + 1))
+        self.outputQ = Signal.like(self.outputI)
+        self.memory = Memory(width=2*sample.width, depth=filter_width, init=[0]*filter_width)
+
+        self.memoutI = Signal(sample)
+        self.memoutQ = Signal(sample)
+        self.addr = Signal(range(filter_width))
+
+        self.enable = Signal(reset=1)
+        self.output_valid = Signal()
+
+    def inputs(self):
+        return [self.inputI, self.inputQ]
+
+    def outputs(self):
+        return [self.outputI, self.outputQ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.rport = rport = self.memory.read_port(domain=self.domain, transparent=False)
+        m.submodules.wport = wport = self.memory.write_port(domain=self.domain)
+
+        domain = getattr(m.d, self.domain)
+
+        sampleI = Signal.like(self.memoutI)
+        sampleQ = Signal.like(self.memoutQ)
+        for sample, input in [(sampleI, self.inputI), (sampleQ, self.inputQ)]:
+            m.d.comb += sample.eq(saturate(input, self.max_val) if self.saturate else input)
+
+        # Addressed exactly as in RunningBoxcarFilter, with I in the low half of each word
+        addr = self.addr
+        width = len(sampleI)
+        domain += [
+            self.memoutI.eq(rport.data[:width]),
+            self.memoutQ.eq(rport.data[width:]),
+        ]
+        m.d.comb += [
+            rport.addr.eq(Mux(addr >= self.filter_width - 2, addr + 2 - self.filter_width, addr + 2)),
+            wport.addr.eq(addr),
+            wport.data.eq(Cat(sampleI, sampleQ)),
+            wport.en.eq(1),
+        ]
+
+        domain += [
+            self.outputI.eq(self.outputI + sampleI - self.memoutI),
+            self.outputQ.eq(self.outputQ + sampleQ - self.memoutQ),
+        ]
+
+        with m.If(addr == self.filter_width - 1):
+            domain += addr.eq(0)
+        with m.Else():
+            domain += addr.eq(addr + 1)
+
+        return clock_enabled(m, self.domain, self.enable, self.output_valid, self.enable)
+
+    def model(self, samplesI, samplesQ):
+        """(outputI, outputQ) for each pair of input samples, as make_callable returns them"""
+        return boxcar_model(self, samplesI, self.inputI, self.outputI), boxcar_model(self, samplesQ, self.inputQ, self.outputQ)
 
 class SimpleDecimator(Elaboratable):
-    def __init__(self, decimation_factor=None, max_val=20, domain="sync"):
+    """
+    Sums each run of decimation_factor inputs into one output. As with
+    RunningBoxcarFilter, max_val is the largest input magnitude (i.e. a boxcar's
+    max_output) and sizes the output to exactly fit max_output = max_val*decimation_factor.
+    Without a max_val, the input is 14 bits and the output 20 bits as they always were.
+    Only inputs on clocks with enable high count, and output_valid is high for the clock
+    after each new output.
+    """
+    def __init__(self, decimation_factor=None, max_val=None, domain="sync", input_width=None, saturate=False):
         self.decimation_factor = decimation_factor
         self.domain = domain
+        if max_val is None:
+            max_val, self.max_output = 2**13 - 1, 2**19 - 1
+        else:
+            self.max_output = max_val*decimation_factor
+        self.max_val = max_val
+        self.saturate = saturate
+
+        sample = Shape.cast(range(-max_val, max_val + 1))
+        self.input = Signal(signed(input_width) if input_width else sample)
+        self.output = Signal(range(-self.max_output, self.max_output + 1))
+
+        max_sum = min(max_val*(decimation_factor - 1), self.max_output)
+        self.running_sum = Signal(range(-max_sum, max_sum + 1))
+        self.counter = Signal(range(decimation_factor))
+
+        self.enable = Signal(reset=1)
+        self.output_valid = Signal()
 
-        self.input = Signal(signed(14))
-        self.output = Signal(signed(20))
+    def inputs(self):
+        return [self.input]
 
-        self.running_sum = Signal(signed(20))
-        self.counter = Signal(signed(8))
+    def outputs(self):
+        return [self.output]
 
     def elaborate(self, platform):
         m = Module()
 
         domain = getattr(m.d, self.domain)
+
+        sample = Signal(range(-self.max_val, self.max_val + 1))
+        m.d.comb += sample.eq(saturate(self.input, self.max_val) if self.saturate else self.input)
+
         with m.If(self.counter == self.decimation_factor - 1):
             domain += [
                 self.counter.eq(0),
-                self.output.eq(self.running_sum + self.input),
+                self.output.eq(self.running_sum + sample),
                 self.running_sum.eq(0)
             ]
         with m.Else():
             domain += [
                 self.counter.eq(self.counter + 1),
-                self.running_sum.eq(self.running_sum + self.input)
+                self.running_sum.eq(self.running_sum + sample)
+            ]
+
+        return clock_enabled(m, self.domain, self.enable, self.output_valid,
+            self.enable & (self.counter == self.decimation_factor - 1))
+
+    def model(self, samples):
+        """output for each input sample, as make_callable returns it: the sum of each run
+           of decimation_factor samples (counting from reset) held from the clock after its
+           last sample until the next one is done"""
+        samples = model_samples(self, samples)
+        blocks = len(samples)//self.decimation_factor
+        sums = wrap(samples[:blocks*self.decimation_factor].reshape(blocks, -1).sum(axis=1), self.output)
+        out = np.zeros(len(samples), np.int64)
+        held = np.repeat(sums, self.decimation_factor)[:max(len(samples) - self.decimation_factor, 0)]
+        out[self.decimation_factor:self.decimation_factor + len(held)] = held
+        return out
+
+def cic_register_widths(order, rate, differential_delay, input_width, output_width=None):
+    """
+    Hogenauer's register widths for a CIC decimator, as a list of the number of LSBs
+    discarded at the input of each of the 2*order stages (integrators then combs) and
+    the full precision output width. Without output_width nothing is discarded and every
+    register is full width. Otherwise each stage drops as many LSBs as it can while
+    keeping its truncation noise at the output below that of rounding the final result
+    down to output_width bits.
+    """
+    full_width = int(np.ceil(order*log2(rate*differential_delay))) + input_width
+    if output_width is None or output_width >= full_width:
+        return [0]*(2*order), full_width
+
+    RM = rate*differential_delay
+    variance = []
+    for j in range(1, 2*order + 1):
+        if j <= order:
+            # Impulse response from the input of integrator j to the output
+            h = [sum((-1)**l*comb(order, l)*comb(order - j + k - RM*l, k - RM*l) for l in range(k//RM + 1))
+                for k in range((RM - 1)*order + j)]
+        else:
+            h = [(-1)**k*comb(2*order + 1 - j, k) for k in range(2*order + 2 - j)]
+        variance.append(sum(c*c for c in h))
+
+    # Standard deviation of the error from rounding the full width result to output_width
+    output_error = log2(2**(full_width - output_width)/np.sqrt(12))
+    discards = []
+    for F2 in variance:
+        bits = floor(-0.5*log2(F2) + output_error + 0.5*log2(6/order))
+        discards.append(min(max(bits, discards[-1] if discards else 0), full_width - output_width))
+    return discards, full_width
+
+class CICDecimator(Elaboratable):
+    """
+    A cascaded integrator-comb decimator: `order` integrators running on every (enabled)
+    input sample followed by `order` combs with a delay of `differential_delay` that only
+    update once every `rate` samples. This has the response of `order` boxcar filters of
+    length rate*differential_delay in a row, but without any memory and with much better
+    alias rejection than a single boxcar and decimator. Registers wrap around and are
+    sized by cic_register_widths(), so the output is exact at full precision (the
+    default, or any output_width of at least full_width, which is clamped to it) or
+    pruned Hogenauer style when a narrower output_width is given.
+
+    output_valid is high for the one cycle after each new output, and inputs are ignored
+    while enable is low. The integrators and combs are all registered, so an input sample
+    first affects the output about `order` outputs (plus `order` samples) later, which
+    model() accounts for exactly.
+    """
+    def __init__(self, rate, order=3, differential_delay=1, input_width=8, output_width=None, domain="sync"):
+        self.rate = rate
+        self.order = order
+        self.differential_delay = differential_delay
+        self.input_width = input_width
+        self.domain = domain
+
+        self.discards, self.full_width = cic_register_widths(order, rate, differential_delay, input_width, output_width)
+        self.output_width = min(output_width or self.full_width, self.full_width)
+        self.widths = [self.full_width - d for d in self.discards]
+
+        self.input = Signal(signed(input_width))
+        self.enable = Signal(reset=1)
+        self.output = Signal(signed(self.output_width))
+        self.output_valid = Signal()
+
+    def inputs(self):
+        return [self.input, self.enable]
+
+    def outputs(self):
+        return [self.output, self.output_valid]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        domain = getattr(m.d, self.domain)
+
+        # Each stage's input is the previous stage's register with the newly discarded
+        # LSBs sliced off. The registers hold everything modulo 2**width so wrapping is fine.
+        # (The first integrator's input is the sign extended input instead.)
+        previous, shift = self.input >> self.discards[0], self.discards[0]
+        stages = []
+        for i, width in enumerate(self.widths):
+            register = Signal(width, name="{}{}".format("integrator" if i < self.order else "comb", i % self.order))
+            stages.append((register, previous if i == 0 else previous[self.discards[i] - shift:]))
+            previous, shift = register, self.discards[i]
+
+        counter = Signal(range(self.rate))
+        dump = Signal()
+        m.d.comb += dump.eq(self.enable & (counter == self.rate - 1))
+
+        with m.If(self.enable):
+            domain += counter.eq(Mux(dump, 0, counter + 1))
+            for register, value in stages[:self.order]:
+                domain += register.eq(register + value)
+
+        with m.If(dump):
+            for register, value in stages[self.order:]:
+                delay = [Signal(len(register), name="{}_delay{}".format(register.name, i)) for i in range(self.differential_delay)]
+                domain += [a.eq(b) for a, b in zip(delay, [value] + delay[:-1])]
+                domain += register.eq(value - delay[-1])
+
+        last = stages[-1][0]
+        domain += self.output_valid.eq(dump)
+        m.d.comb += self.output.eq(last[len(last) - self.output_width:])
+
+        return m
+
+    def model(self, samples):
+        """The sequence of outputs produced (one per output_valid) for the enabled input samples"""
+        samples = np.asarray(samples).astype(np.int64)
+
+        # value[n] is each register after n enabled clocks, as in hardware everything wraps
+        # around, which uint64 arithmetic does for free as long as no register is wider.
+        # Wider ones fall back to (much slower) Python ints.
+        if max(self.widths) <= 64:
+            values, word = samples.astype(np.uint64), np.uint64
+        else:
+            values, word = samples.astype(object), int
+        shift = 0
+        for i in range(self.order):
+            values = values >> word(self.discards[i] - shift)
+            values = np.concatenate([np.zeros(1, values.dtype), np.cumsum(values, dtype=values.dtype)[:-1]])
+            values &= word(2**self.widths[i] - 1)
+            shift = self.discards[i]
+
+        values = values[self.rate - 1::self.rate]
+        for i in range(self.order, 2*self.order):
+            values = values >> word(self.discards[i] - shift)
+            mask = word(2**self.widths[i] - 1)
+            # The first comb subtracts its input from differential_delay dumps ago, later ones
+            # also see their inputs a dump late because the previous comb is registered
+            late = 0 if i == self.order else 1
+            padded = np.concatenate([np.zeros(self.differential_delay + late, values.dtype), values])
+            values = (padded[self.differential_delay:len(padded) - late] - padded[:len(values)]) & mask
+            shift = self.discards[i]
+
+        last = self.widths[-1]
+        values = values >> word(last - self.output_width)
+        half = 2**(self.output_width - 1)
+        if word is int:
+            return (values + half) % (2*half) - half
+        values = values.astype(np.int64)
+        return np.where(values >= half, values - 2*half, values)
+
+class PolyphaseDecimator(Elaboratable):
+    """
+    An FIR filter with arbitrary coefficients followed by decimation by `rate`, that only
+    computes the outputs it keeps. Each input sample contributes to the ceil(taps/rate)
+    outputs still in progress, with a coefficient picked by its phase within the block of
+    `rate` inputs, so those partial outputs are kept in accumulators rather than keeping
+    the samples in a delay line. When inputs (enable high) arrive at most once every
+    `clocks_per_sample` clocks, the products for each sample are spread over that many
+    clocks to need even fewer multipliers.
+
+    Floating point coefficients are scaled to coefficient_bits signed integers. The output
+    is full precision and is updated, with output_valid high, at the end of every block.
+    """
+    def __init__(self, coefficients, rate, input_width=8, clocks_per_sample=1, coefficient_bits=16, domain="sync"):
+        coefficients = np.asarray(coefficients)
+        if not np.issubdtype(coefficients.dtype, np.integer):
+            scale = (2**(coefficient_bits - 1) - 1)/np.abs(coefficients).max()
+            coefficients = np.round(coefficients*scale)
+        self.coefficients = [int(c) for c in coefficients]
+
+        self.rate = rate
+        self.input_width = input_width
+        self.clocks_per_sample = clocks_per_sample
+        self.domain = domain
+
+        self.accumulators = ceil(len(self.coefficients)/rate)
+        self.multipliers = ceil(self.accumulators/clocks_per_sample)
+        self.direct_form_multipliers = len(self.coefficients)
+
+        max_output = 2**(input_width - 1)*sum(abs(c) for c in self.coefficients)
+        self.input = Signal(signed(input_width))
+        self.enable = Signal(reset=1)
+        self.output = Signal(range(-max_output, max_output + 1))
+        self.output_valid = Signal()
+
+    def inputs(self):
+        return [self.input, self.enable]
+
+    def outputs(self):
+        return [self.output, self.output_valid]
+
+    def tap(self, accumulator, phase):
+        """The coefficient accumulator (0 being the output finishing in this block) applies
+           to a sample `phase` inputs into the block"""
+        i = accumulator*self.rate + self.rate - 1 - phase
+        return self.coefficients[i] if i < len(self.coefficients) else 0
+
+    def elaborate(self, platform):
+        m = Module()
+
+        domain = getattr(m.d, self.domain)
+
+        # The latest sample, where it falls in its block and which of the clocks spent on it this is
+        sample = Signal(signed(self.input_width))
+        phase = Signal(range(self.rate))
+        next_phase = Signal(range(self.rate))
+        slot = Signal(range(self.clocks_per_sample))
+        busy = Signal()
+
+        with m.If(busy):
+            domain += slot.eq(slot + 1)
+            with m.If(slot == self.clocks_per_sample - 1):
+                domain += busy.eq(0)
+        with m.If(self.enable):
+            domain += [
+                sample.eq(self.input),
+                phase.eq(next_phase),
+                next_phase.eq(Mux(next_phase == self.rate - 1, 0, next_phase + 1)),
+                slot.eq(0),
+                busy.eq(1),
             ]
 
-        return m
\ No newline at end of file
+        # Multiplier u handles accumulator slot*multipliers + u, with coefficients looked up
+        # by slot and phase
+        products = []
+        for u in range(self.multipliers):
+            coefficient = Array(Const(self.tap(s*self.multipliers + u, p))
+                for s in range(self.clocks_per_sample) for p in range(self.rate))[slot*self.rate + phase]
+            product = Signal.like(self.output, name="product{}".format(u))
+            m.d.comb += product.eq(coefficient*sample)
+            products.append(product)
+
+        accumulators = [Signal.like(self.output, name="accumulator{}".format(j)) for j in range(self.accumulators)]
+        updated = [Signal.like(self.output, name="updated{}".format(j)) for j in range(self.accumulators)]
+        for j, (accumulator, value) in enumerate(zip(accumulators, updated)):
+            s, u = divmod(j, self.multipliers)
+            m.d.comb += value.eq(Mux(busy & (slot == s), accumulator + products[u], accumulator))
+
+        # After the last product for the last sample in a block, the oldest accumulator is done
+        dump = Signal()
+        m.d.comb += dump.eq(busy & (slot == self.clocks_per_sample - 1) & (phase == self.rate - 1))
+        domain += self.output_valid.eq(dump)
+        with m.If(dump):
+            domain += self.output.eq(updated[0])
+            domain += [a.eq(b) for a, b in zip(accumulators, updated[1:] + [0])]
+        with m.Else():
+            domain += [a.eq(b) for a, b in zip(accumulators, updated)]
+
+        return m
+
+    def model(self, samples):
+        """The sequence of outputs produced (one per output_valid) for the enabled input samples"""
+        samples = np.asarray(samples).astype(np.int64)
+        filtered = np.convolve(samples, np.array(self.coefficients, dtype=np.int64))
+        return filtered[self.rate - 1:len(samples)//self.rate*self.rate:self.rate]
+
+def test_boxcar_widths():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(3)
+    for length, max_val, input_width in [(3, 1, None), (4, 20, None), (7, 3, None), (16, 127, None), (10, 100, 10), (5, 20, 8)]:
+        saturating = input_width is not None
+        limit = 2**(input_width - 1) - 1 if saturating else max_val
+
+        # Full scale runs in both directions, then random values (past max_val when saturating)
+        samples = np.concatenate([
+            np.full(2*length, limit), np.full(2*length, -limit),
+            rng.integers(-limit, limit + 1, 8*length)])
+        clamped = np.clip(samples, -max_val, max_val)
+
+        boxcar = RunningBoxcarFilter(length, max_val=max_val, input_width=input_width, saturate=saturating)
+        boxcar_callable = make_callable(boxcar)
+        outputs = [boxcar_callable(int(x)) for x in samples]
+        expected = np.convolve(clamped, np.ones(length, np.int64))[:len(samples) - 1]
+        assert outputs == [0] + list(expected)
+        assert max(abs(x) for x in outputs) == boxcar.max_output
+
+        decimator = SimpleDecimator(length, max_val=max_val, input_width=input_width, saturate=saturating)
+        decimator_callable = make_callable(decimator)
+        outputs = [decimator_callable(int(x)) for x in samples]
+        expected = clamped[:len(samples)//length*length].reshape(-1, length).sum(axis=1)
+        assert outputs[length::length] == list(expected[:len(outputs[length::length])])
+        assert max(abs(x) for x in outputs) == decimator.max_output
+
+        # And nothing is any wider than it has to be to get there
+        assert len(boxcar.running_sum) == len(decimator.output) == Shape.cast(range(-max_val*length, max_val*length + 1)).width
+
+    # Without a max_val they're as wide as they always were
+    boxcar, decimator = RunningBoxcarFilter(128), SimpleDecimator(4)
+    assert (boxcar.input.shape(), boxcar.output.shape()) == (signed(8), signed(14))
+    assert (decimator.input.shape(), decimator.output.shape()) == (signed(14), signed(20))
+    assert max(boxcar.model(np.concatenate([[64], np.zeros(200)]))) == 64
+    assert list(decimator.model([128, 127, 120, 114, 0, 0, 0, 0, 0])[4::4]) == [489, 0]
+
+def test_filter_models():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(5)
+    for length, max_val, input_width, saturating in [(5, 20, None, False), (12, 7, 8, False), (9, 30, 8, True), (3, 127, None, False)]:
+        boxcar = RunningBoxcarFilter(length, max_val=max_val, input_width=input_width, saturate=saturating)
+        decimator = SimpleDecimator(length, max_val=max_val, input_width=input_width, saturate=saturating)
+
+        # Anything the input can hold, including values past max_val that wrap (or saturate)
+        samples = rng.integers(-2**(len(boxcar.input) - 1), 2**(len(boxcar.input) - 1), 40*length)
+        for block, name in [(boxcar, "boxcar"), (decimator, "decimator")]:
+            block_callable = make_callable(block)
+            outputs = [block_callable(int(x)) for x in samples]
+            assert outputs == list(block.model(samples)), "{} mismatch for length {}".format(name, length)
+
+def test_iq_boxcar():
+    from alldigitalradio.io.numpy import make_callable
+    from alldigitalradio.resources import resource_usage
+
+    rng = np.random.default_rng(6)
+    for length, max_val, input_width, saturating in [(16, 80, None, False), (7, 20, 8, True), (5, 3, 6, False)]:
+        iq = IQBoxcarFilter(length, max_val=max_val, input_width=input_width, saturate=saturating)
+        pair = [RunningBoxcarFilter(length, max_val=max_val, input_width=input_width, saturate=saturating) for _ in range(2)]
+
+        limit = 2**(len(iq.inputI) - 1)
+        samples = rng.integers(-limit, limit, (2, 30*length))
+        iq_callable = make_callable(iq)
+        pair_callables = [make_callable(f) for f in pair]
+        for i, q in samples.T:
+            assert iq_callable(int(i), int(q)) == [pair_callables[0](int(i)), pair_callables[1](int(q))]
+
+        expectedI, expectedQ = iq.model(*samples)
+        assert (expectedI == pair[0].model(samples[0])).all() and (expectedQ == pair[1].model(samples[1])).all()
+
+        iq_usage = resource_usage(iq)
+        pair_usage = [resource_usage(f) for f in pair]
+        assert iq_usage['memories'] == 1 and sum(u['memories'] for u in pair_usage) == 2
+        assert iq_usage['memory_bits'] == sum(u['memory_bits'] for u in pair_usage)
+        assert iq_usage['registers'] < sum(u['registers'] for u in pair_usage)
+
+def test_clock_enable():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(7)
+    samples = rng.integers(-20, 21, (2, 200))
+    enables = rng.integers(0, 3, 600) > 0
+
+    boxcar = RunningBoxcarFilter(9, max_val=20)
+    iq = IQBoxcarFilter(9, max_val=20)
+    decimator = SimpleDecimator(9, max_val=20)
+    for block, inputs, outputs, expected in [
+            (boxcar, [boxcar.input], [boxcar.output], [boxcar.model(samples[0])]),
+            (iq, [iq.inputI, iq.inputQ], [iq.outputI, iq.outputQ], iq.model(*samples)),
+            (decimator, [decimator.input], [decimator.output], [decimator.model(samples[0])])]:
+        block_callable = make_callable(block, inputs=inputs + [block.enable], outputs=outputs + [block.output_valid])
+
+        # Stalls in between make no difference to the outputs for the samples that are enabled
+        valid, i = [], 0
+        for enable in enables:
+            if i == samples.shape[1]:
+                break
+            out = block_callable(*[int(x) for x in samples[:len(inputs), i]], int(enable))
+            if out[-1]:
+                valid.append(out[:-1])
+            i += int(enable)
+
+        if block is decimator:
+            expected = [e[decimator.decimation_factor::decimator.decimation_factor] for e in expected]
+        else:
+            expected = [e[1:] for e in expected]
+        assert valid == [list(e) for e in zip(*expected)][:len(valid)]
+        assert len(valid) >= len(expected[0]) - 1
+
+def test_cic_decimator():
+    from alldigitalradio.io.numpy import make_callable
+    from alldigitalradio.resources import resource_usage
+
+    rng = np.random.default_rng(0)
+    for rate, order, differential_delay, output_width in [(4, 3, 1, None), (8, 4, 2, None), (16, 3, 1, 10), (5, 2, 1, 9), (4, 3, 1, 20)]:
+        cic = CICDecimator(rate, order=order, differential_delay=differential_delay, input_width=8, output_width=output_width)
+        samples = rng.integers(-128, 128, rate*40)
+        expected = cic.model(samples)
+
+        # At full precision it's exactly order boxcars in a row, decimated and delayed
+        if output_width is None or output_width >= cic.full_width:
+            assert cic.output_width == cic.full_width
+            response = np.ones(1, np.int64)
+            for _ in range(order):
+                response = np.convolve(response, np.ones(rate*differential_delay, np.int64))
+            exact = np.convolve(samples, response)[:len(samples)][rate - 1 - order::rate]
+            assert (expected[order - 1:] == exact[:len(expected) - order + 1]).all()
+        else:
+            # Pruning only adds a little noise on top of truncating the full precision result
+            full = CICDecimator(rate, order=order, differential_delay=differential_delay, input_width=8).model(samples)
+            assert np.abs(expected - (full >> (cic.full_width - output_width))).max() <= 2
+
+        # Stalls with enable low don't change anything
+        cic_callable = make_callable(cic)
+        outputs, i = [], 0
+        while i < len(samples):
+            enable = rng.integers(0, 4) > 0
+            output, valid = cic_callable(int(samples[i]), int(enable))
+            if valid:
+                outputs.append(output)
+            i += int(enable)
+        assert outputs == list(expected[:len(outputs)])
+        assert len(outputs) >= len(expected) - 1
+
+        assert resource_usage(cic)['memories'] == 0
+
+    # Registers wider than 64 bits are modelled exactly too
+    cic = CICDecimator(16, order=15, input_width=8)
+    assert cic.full_width > 64
+    samples = rng.integers(-128, 128, 16*30)
+    cic_callable = make_callable(cic)
+    outputs = [output for output, valid in (cic_callable(int(x), 1) for x in samples) if valid]
+    assert outputs == list(cic.model(samples)[:len(outputs)])
+    assert len(outputs) >= 28 and max(abs(x) for x in outputs) > 2**63
+
+def test_polyphase_decimator():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(4)
+    lowpass = np.sinc(np.linspace(-3, 3, 25))*np.hamming(25)
+    for coefficients, rate, clocks_per_sample in [(lowpass, 4, 1), (lowpass, 5, 3), (rng.integers(-100, 100, 7), 8, 2), ([1, 2, 3], 1, 1)]:
+        fir = PolyphaseDecimator(coefficients, rate, clocks_per_sample=clocks_per_sample)
+        assert fir.multipliers == ceil(ceil(len(fir.coefficients)/rate)/clocks_per_sample)
+        assert fir.multipliers <= fir.direct_form_multipliers
+
+        samples = rng.integers(-128, 128, rate*12)
+        expected = fir.model(samples)
+        assert (expected == [sum(c*samples[k*rate + rate - 1 - i] for i, c in enumerate(fir.coefficients)
+            if k*rate + rate - 1 - i >= 0) for k in range(len(samples)//rate)]).all()
+
+        # Feed samples as fast as the clock budget allows, with some random gaps
+        fir_callable = make_callable(fir)
+        outputs, i, wait = [], 0, 0
+        for _ in range(len(samples)*(clocks_per_sample + 1) + 4):
+            enable = i < len(samples) and wait == 0 and rng.integers(0, 4) > 0
+            output, valid = fir_callable(int(samples[i]) if enable else 0, int(enable))
+            if valid:
+                outputs.append(output)
+            wait = clocks_per_sample - 1 if enable else max(wait - 1, 0)
+            i += int(enable)
+        assert i == len(samples)
+        assert outputs == list(expected)
+
+if __name__ == '__main__':
+    import time
+
+    samples = np.random.default_rng(0).integers(-20, 21, 20*1000*1000)
+    for block in [RunningBoxcarFilter(1000, max_val=20), SimpleDecimator(1000, max_val=20)]:
+        start = time.time()
+        block.model(samples)
+        print("{:>20}: {:12.0f} samples/s".format(type(block).__name__, len(samples)/(time.time() - start)))
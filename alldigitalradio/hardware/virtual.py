@@ -10,6 +10,7 @@ from nmigen.back import verilog
 HARNESS = """
 #include "Vtop.h"
 #include <cstdio>
+#include <cstring>
 #include <vector>
 #include "verilated_vcd_c.h"
 
@@ -23,7 +24,7 @@ int main(int argc, char** argv) {
     printf("Reading %s\\n", argv[1]);
 
 	FILE *fp;
-	fp = fopen(argv[1], "r");
+	fp = fopen(argv[1], "rb");
 
     if (fp == NULL) {
         printf("Failed to find file\\n");
@@ -32,46 +33,60 @@ int main(int argc, char** argv) {
 	FILE *out;
 	out = fopen("out.txt", "w");
 
-	uint32_t input = 0;
-	int bit = 0;
-
 	uint64_t time = 0;
 	int rdy_last = 0;
 
-	int c;
-	while (fp) {
-		c = fgetc(fp);
-
-		if (feof(fp)) {
-			break;
-		}
-		if (c == '1') {
-			input |= (1 << bit);
+	auto step = [&](uint32_t input) {
+		if (top.tx_rdy && rdy_last == 0) {
+			printf("%c", top.tx_data);
 		}
-		if (bit == 19) {
-			if (top.tx_rdy && rdy_last == 0) {
-				printf("%c", top.tx_data);
+		rdy_last = top.tx_rdy;
+
+		top.rx_data = input;
+		top.rx_clock = 0;
+		top.eval();
+		tfp->dump(time++);
+
+		top.clk = (((time - 1) % 20) < 10) ? 1 : 0;
+
+		top.rx_clock = 1;
+		top.eval();
+		tfp->dump(time++);
+
+		top.clk = (((time - 1) % 20) < 10) ? 1 : 0;
+	};
+
+	size_t len = strlen(argv[1]);
+	if (len > 4 && strcmp(argv[1] + len - 4, ".bin") == 0) {
+		// Packed captures (util.PackedBits.save) are little-endian 32-bit words
+		uint32_t words[4096];
+		size_t count;
+		while (fp && (count = fread(words, sizeof(uint32_t), 4096, fp)) > 0) {
+			for (size_t i = 0; i < count; i++) {
+				step(words[i] & 0xFFFFF);
 			}
-			rdy_last = top.tx_rdy;
-
-			top.rx_data = input;
-			top.rx_clock = 0;
-			top.eval();
-			tfp->dump(time++);
-
-			top.clk = (((time - 1) % 20) < 10) ? 1 : 0;
-
-			top.rx_clock = 1;
-			top.eval();
-			tfp->dump(time++);
+		}
+	} else {
+		uint32_t input = 0;
+		int bit = 0;
 
-			top.clk = (((time - 1) % 20) < 10) ? 1 : 0;
-			
-			bit = 0;
-			input = 0;
+		int c;
+		while (fp) {
+			c = fgetc(fp);
 
-		} else {
-			bit += 1;
+			if (feof(fp)) {
+				break;
+			}
+			if (c == '1') {
+				input |= (1 << bit);
+			}
+			if (bit == 19) {
+				step(input);
+				bit = 0;
+				input = 0;
+			} else {
+				bit += 1;
+			}
 		}
 	}
 
@@ -1,5 +1,6 @@
 import numpy as np
 
+from alldigitalradio.util import PackedBits
 from nmigen.sim import Simulator, Tick, Settle
 from nmigen import *
 
@@ -61,12 +62,22 @@ def make_callable(m, startup_cycles=0, inputs=None, outputs=None):
 
     def tick(*inputs):
         next(g)
-        return g.send(inputs)
+        # Signal.eq() doesn't take numpy scalars (i.e. words from pack_mem)
+        return g.send([int(i) for i in inputs])
     return tick
 
 def take_n(f, n):
     return np.array([f() for _ in range(n)])
 
+def stream(f, chunks):
+    """Feeds every word from an iterable of word arrays (i.e. util.stream_carrier)
+       or a PackedBits capture into a single-input callable, yielding each output as it goes."""
+    if isinstance(chunks, PackedBits):
+        chunks = [chunks]
+    for chunk in chunks:
+        for word in chunk:
+            yield f(int(word))
+
 def test_make_callable():
     class Doubler(Elaboratable):
         def __init__(self):
@@ -88,3 +99,4 @@ def test_make_callable():
     assert doubler(1) == [2, 0]
     assert doubler(2) == [4, 2]
     assert doubler(2) == [4, 4]
+    assert doubler(np.uint32(3)) == [6, 4]
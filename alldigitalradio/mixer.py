@@ -2,104 +2,504 @@ import numpy as np
 
 from nmigen import *
 from nmigen.sim import Simulator
-from alldigitalradio.oscillator import OneBitFixedOscillator
+from alldigitalradio.resources import resource_usage
+from alldigitalradio.util import popcount, popcount_tree, split_chunks, tree_stages, word_chunks, word_dtype
+from alldigitalradio.cache import pattern_cache
+from alldigitalradio.oscillator import (
+    OneBitDDSOscillator,
+    OneBitIQOscillator,
+    OneBitMultiFrequencyOscillator
+)
+
+OSCILLATORS = {
+    'rom': OneBitIQOscillator,
+    'dds': OneBitDDSOscillator,
+}
+
+def make_oscillators(sample_rate, frequency, max_error, width, domain, mode, cache=pattern_cache):
+    """Builds the (I, Q, select) local oscillators a mixer uses, see SummingMixer"""
+    kwargs = dict(sample_rate=sample_rate, max_error=max_error, width=width, domain=domain)
+    if isinstance(frequency, (list, tuple)):
+        select = Signal(range(len(frequency)))
+        return (OneBitMultiFrequencyOscillator(frequencies=frequency, cache=cache, **kwargs),
+                OneBitMultiFrequencyOscillator(frequencies=frequency, phase=np.pi/2, cache=cache, **kwargs),
+                select)
+    elif mode == 'rom':
+        oscillator = OneBitIQOscillator(frequency=frequency, cache=cache, **kwargs)
+        return oscillator, oscillator, None
+    else:
+        return (OSCILLATORS[mode](frequency=frequency, **kwargs),
+                OSCILLATORS[mode](frequency=frequency, phase=np.pi/2, **kwargs),
+                None)
+
+def add_oscillators(m, oscillatorI, oscillatorQ, select, name="oscillator"):
+    """Adds the oscillators to m and returns their (I, Q) output words"""
+    if select is not None:
+        m.d.comb += [
+            oscillatorI.select.eq(select),
+            oscillatorQ.select.eq(select)
+        ]
+
+    if oscillatorI is oscillatorQ:
+        setattr(m.submodules, name, oscillatorI)
+        return oscillatorI.outputI, oscillatorI.outputQ
+
+    setattr(m.submodules, name + "I", oscillatorI)
+    setattr(m.submodules, name + "Q", oscillatorQ)
+    return oscillatorI.output, oscillatorQ.output
+
+def oscillator_models(oscillatorI, oscillatorQ, words, dtype, start=0):
+    """The (I, Q) oscillator words that input words start..start + words - 1 get mixed
+       with in hardware, which are the oscillator outputs from the clock before (0 out of reset)"""
+    if start == 0:
+        return [np.concatenate([np.zeros(1, dtype), o[:-1].astype(dtype)])
+            for o in oscillator_models(oscillatorI, oscillatorQ, words, dtype, start=1)]
+
+    if oscillatorI is oscillatorQ:
+        outputs = oscillatorI.model(words, start=start - 1)
+    else:
+        outputs = oscillatorI.model(words, start=start - 1), oscillatorQ.model(words, start=start - 1)
+    return [o.astype(dtype, copy=False) for o in outputs]
+
+def moving_sums(per_word, history):
+    """The sums of each 4 consecutive values of `history` (the per-word values from the
+       previous chunk, oldest first) followed by `per_word`, one for each of per_word,
+       along with the history to pass in with the next chunk"""
+    values = np.concatenate([history, per_word])
+    running = np.concatenate([np.zeros(1, np.int64), np.cumsum(values, dtype=np.int64)])
+    return running[4:4 + len(per_word)] - running[:len(per_word)], values[len(values) - len(history):]
 
 class SummingMixer(Elaboratable):
-    def __init__(self, sample_rate=None, frequency=None, max_error=None, width=20, domain='sync', slowdomain="rxdiv4"):
+    def __init__(self, sample_rate=None, frequency=None, max_error=None, width=20, domain='sync', slowdomain="rxdiv4", mode="rom", split=2, levels_per_stage=1, decimate=False, cache=pattern_cache):
+        """mode selects how the local oscillators are built, either a ROM of a whole
+           period shared between I and Q ("rom") or a phase accumulator ("dds"). If
+           frequency is a list, the oscillators hold a pattern for each frequency and
+           `select` picks which one to downconvert at runtime.
+
+           Each input word is split into `split` chunks whose popcounts are added up by
+           an adder tree with a register after every `levels_per_stage` levels (and
+           after the last). `latency` is the number of words between an input word
+           and the first outputIsum/outputQsum that includes it.
+
+           With decimate, the moving sum is replaced by an accumulator that is dumped into
+           outputIsum/outputQsum every 4 words, which then hold their value for 4 words
+           with `output_valid` high for the first of them. These are the model() outputs
+           for every 4th word. If slowdomain isn't None, outputIslow/outputQslow also
+           register them in slowdomain, which has to be clocked at a quarter of domain
+           from the same source (i.e. a divided rx clock): each slow clock then samples
+           exactly one held sum, whatever its phase. Otherwise downstream logic can stay
+           in domain and only act on output_valid.
+
+           The ROM oscillators' patterns are looked up in (and added to) cache, which
+           can be None to always compute them (see PatternCache)."""
         self.width = width
         self.domain = domain
         self.slowdomain = slowdomain
+        self.decimate = decimate
+
+        self.oscillatorI, self.oscillatorQ, self.select = make_oscillators(
+            sample_rate, frequency, max_error, width, domain, mode, cache)
+
+        self.split = split
+        self.levels_per_stage = levels_per_stage
+        self.chunks = split_chunks(width, split)
+        self.tree_stages = tree_stages(split, levels_per_stage)
 
-        self.oscillatorI = OneBitFixedOscillator(
-                sample_rate=sample_rate, 
-                frequency=frequency, 
-                max_error=max_error, 
-                width=width, 
-                domain=domain)
-
-        self.oscillatorQ = OneBitFixedOscillator(
-                sample_rate=sample_rate, 
-                frequency=frequency, 
-                max_error=max_error, 
-                width=width, 
-                phase=np.pi/2,
-                domain=domain)
+        # chunk popcounts, tree, positive - negative, shift register, moving sum
+        self.latency = 1 + self.tree_stages + 1 + 1 + 1
+        if decimate:
+            # The accumulator dump takes the place of both the shift register and moving sum
+            self.latency -= 1
+        self.popcount_bits = 4*width
 
         self.input = Signal(width)
-        self.outputI = Signal(signed(7)) #range(-2*width, 2*width))
-        self.outputQ = Signal(signed(7)) #range(-2*width, 2*width))
+        self.outputI = Signal(range(-width, width + 1))
+        self.outputQ = Signal(range(-width, width + 1))
 
-        self.outputIshift = Signal(unsigned(7*4))
-        self.outputQshift = Signal(unsigned(7*4))
+        self.outputIsum = Signal(range(-4*width, 4*width + 1))
+        self.outputQsum = Signal(range(-4*width, 4*width + 1))
 
-        self.outputIsum = Signal(signed(9))
-        self.outputQsum = Signal(signed(9))
+        if decimate:
+            self.phase = Signal(2)
+            self.output_valid = Signal()
+            # Sums of the first 3 of every 4 words
+            self.outputIacc = Signal(range(-3*width, 3*width + 1))
+            self.outputQacc = Signal(range(-3*width, 3*width + 1))
+            self.outputIslow = Signal.like(self.outputIsum)
+            self.outputQslow = Signal.like(self.outputQsum)
+        else:
+            # The last 4 words' values for the moving sum
+            self.outputIshift = Signal(len(self.outputI)*4)
+            self.outputQshift = Signal(len(self.outputQ)*4)
 
     def inputs(self):
+        if self.select is not None:
+            return [self.input, self.select]
         return [self.input]
 
     def outputs(self):
+        if self.decimate:
+            return [self.outputIsum, self.outputQsum, self.output_valid]
         return [self.outputIsum, self.outputQsum]
-        
+
+    def valid_phase(self):
+        """The model() indices with output_valid high are the ones congruent to this mod 4"""
+        return self.latency % 4
+
     def elaborate(self, platform):
         m = Module()
 
-        m.submodules.oscillatorI = self.oscillatorI
-        m.submodules.oscillatorQ = self.oscillatorQ
+        oscillatorI, oscillatorQ = add_oscillators(m, self.oscillatorI, self.oscillatorQ, self.select)
 
-        ipsum = Signal(signed(5))
-        ipsumA = Signal(signed(5))
-        ipsumB = Signal(signed(5))
+        domain = getattr(m.d, self.domain)
 
-        insum = Signal(signed(5))
-        insumA = Signal(signed(5))
-        insumB = Signal(signed(5))
+        popcount = lambda bits, name: popcount_tree(m, domain, bits, self.chunks, self.levels_per_stage, name)
+        ipsum = popcount(oscillatorI & self.input, "ipsum")
+        insum = popcount((~oscillatorI) & self.input, "insum")
+        qpsum = popcount(oscillatorQ & self.input, "qpsum")
+        qnsum = popcount((~oscillatorQ) & self.input, "qnsum")
 
-        qpsum = Signal(signed(5))
-        qpsumA = Signal(signed(5))
-        qpsumB = Signal(signed(5))
+        domain += [
+            self.outputI.eq(ipsum - insum),
+            self.outputQ.eq(qpsum - qnsum),
+        ]
 
-        qnsum = Signal(signed(5))
-        qnsumA = Signal(signed(5))
-        qnsumB = Signal(signed(5))
+        if self.decimate:
+            # outputI/outputQ hold the word from latency - 1 clocks ago, so dumping on this
+            # phase lines the sums up with model() indices valid_phase() mod 4
+            dump = self.phase == (self.latency - 1) % 4
+            domain += [
+                self.phase.eq(self.phase + 1),
+                self.output_valid.eq(dump),
+            ]
+            with m.If(dump):
+                domain += [
+                    self.outputIsum.eq(self.outputIacc + self.outputI),
+                    self.outputQsum.eq(self.outputQacc + self.outputQ),
+                    self.outputIacc.eq(0),
+                    self.outputQacc.eq(0),
+                ]
+            with m.Else():
+                domain += [
+                    self.outputIacc.eq(self.outputIacc + self.outputI),
+                    self.outputQacc.eq(self.outputQacc + self.outputQ),
+                ]
 
-        domain = getattr(m.d, self.domain)
+            if self.slowdomain is not None:
+                slowdomain = getattr(m.d, self.slowdomain)
+                slowdomain += [
+                    self.outputIslow.eq(self.outputIsum),
+                    self.outputQslow.eq(self.outputQsum),
+                ]
+            return m
 
+        n = len(self.outputI)
         domain += [
-            ipsumA.eq(sum(self.oscillatorI.output[0:10] & self.input[0:10])),
-            ipsumB.eq(sum(self.oscillatorI.output[10:20] & self.input[10:20])),
-            ipsum.eq(ipsumA + ipsumB),
-
-            insumA.eq(sum((~self.oscillatorI.output[0:10]) & self.input[0:10])),
-            insumB.eq(sum((~self.oscillatorI.output[10:20]) & self.input[10:20])),
-            insum.eq(insumA + insumB),
-
-            self.outputI.eq((ipsum - insum)),
-
-            qpsumA.eq(sum(self.oscillatorQ.output[0:10] & self.input[0:10])),
-            qpsumB.eq(sum(self.oscillatorQ.output[10:20] & self.input[10:20])),
-            qpsum.eq(qpsumA + qpsumB),
-
-            qnsumA.eq(sum((~self.oscillatorQ.output[0:10]) & self.input[0:10])),
-            qnsumB.eq(sum((~self.oscillatorQ.output[10:20]) & self.input[10:20])),
-            qnsum.eq(qnsumA + qnsumB),
-
-            self.outputQ.eq((qpsum - qnsum)),
-
-            self.outputIshift.eq(Cat(self.outputI, self.outputIshift[0:7*3])),
-            self.outputIsum.eq(
-                self.outputIshift[7*0:7*1].as_signed() +
-                self.outputIshift[7*1:7*2].as_signed() +
-                self.outputIshift[7*2:7*3].as_signed() +
-                self.outputIshift[7*3:7*4].as_signed()
-            ),
-            self.outputQshift.eq(Cat(self.outputQ, self.outputQshift[0:7*3])),
-            self.outputQsum.eq(
-                self.outputQshift[7*0:7*1].as_signed() +
-                self.outputQshift[7*1:7*2].as_signed() +
-                self.outputQshift[7*2:7*3].as_signed() +
-                self.outputQshift[7*3:7*4].as_signed()
-            )
+            self.outputIshift.eq(Cat(self.outputI, self.outputIshift[0:n*3])),
+            self.outputIsum.eq(sum(self.outputIshift[n*i:n*(i + 1)].as_signed() for i in range(4))),
+            self.outputQshift.eq(Cat(self.outputQ, self.outputQshift[0:n*3])),
+            self.outputQsum.eq(sum(self.outputQshift[n*i:n*(i + 1)].as_signed() for i in range(4))),
         ]
 
-        return m
\ No newline at end of file
+        return m
+
+    def model(self, words):
+        """(outputIsum, outputQsum) for each input word. Without decimate these are exactly
+           what make_callable returns, with it they're the moving sums the accumulator
+           dumps, so the hardware only matches them on the words k with
+           k % 4 == valid_phase() (and holds them for the 3 words after). Hopping mixers
+           (with a list of frequencies) aren't modelled and raise a ValueError."""
+        outputs = list(self.stream_model([words]))
+        return tuple(np.concatenate([np.zeros(0, np.int64)] + [o[i] for o in outputs]) for i in range(2))
+
+    def stream_model(self, chunks, chunk_words=1 << 20):
+        """model() for a capture that arrives in pieces, which can be anything
+           util.word_chunks() takes (i.e. a memory-mapped PackedBits), yielding
+           (outputIsum, outputQsum) for each chunk of at most chunk_words words. The
+           oscillator phase and the pipeline carry over from one chunk to the next, so the
+           concatenated outputs are identical to model() on the whole capture.
+
+           The positive and negative popcounts are computed as 2*popcount(lo & input) -
+           popcount(input), which comes out the same but saves a popcount."""
+        if self.select is not None:
+            raise ValueError("Only fixed frequency mixers can be modelled, not hopping ones")
+        return self._stream_model(chunks, chunk_words)
+
+    def _stream_model(self, chunks, chunk_words):
+        dtype = word_dtype(self.width)
+        # Per-word I and Q values still in the pipeline or shift register
+        historyI = historyQ = np.zeros(self.latency + 3, np.int64)
+        start = 0
+        for words in word_chunks(chunks, chunk_words):
+            words = words.astype(dtype, copy=False)
+            loI, loQ = oscillator_models(self.oscillatorI, self.oscillatorQ, len(words), dtype, start=start)
+            count = popcount(words)
+            outputI, historyI = moving_sums(2*popcount(loI & words) - count, historyI)
+            outputQ, historyQ = moving_sums(2*popcount(loQ & words) - count, historyQ)
+            start += len(words)
+            yield outputI, outputQ
+
+class MixerBank(Elaboratable):
+    """
+    Downconverts one input word to several frequencies at once, with the same outputs
+    (and latency) as a SummingMixer per frequency. Since the negative half of each
+    product is popcount(~lo & input) = popcount(input) - popcount(lo & input), each
+    output is 2*sum(popcount(lo & input)) - sum(popcount(input)) and the input popcount
+    and its 4-word moving sum are computed once and shared by every channel. That
+    leaves two popcount trees per channel instead of four.
+    Oscillator patterns are cached as for SummingMixer.
+    """
+    def __init__(self, sample_rate=None, frequencies=None, max_error=None, width=20, domain='sync', mode="rom", split=2, levels_per_stage=1, cache=pattern_cache):
+        self.width = width
+        self.domain = domain
+        self.frequencies = frequencies
+
+        self.oscillators = [make_oscillators(sample_rate, frequency, max_error, width, domain, mode, cache)[:2]
+            for frequency in frequencies]
+
+        self.split = split
+        self.levels_per_stage = levels_per_stage
+        self.chunks = split_chunks(width, split)
+        self.tree_stages = tree_stages(split, levels_per_stage)
+
+        # chunk popcounts, tree, shift register, moving sum, 2*positive - total
+        self.latency = 1 + self.tree_stages + 1 + 1 + 1
+        self.popcount_bits = (2*len(frequencies) + 1)*width
+
+        self.input = Signal(width)
+        self.outputIsum = [Signal(range(-4*width, 4*width + 1), name="outputIsum{}".format(i)) for i in range(len(frequencies))]
+        self.outputQsum = [Signal(range(-4*width, 4*width + 1), name="outputQsum{}".format(i)) for i in range(len(frequencies))]
+
+    def inputs(self):
+        return [self.input]
+
+    def outputs(self):
+        return [s for pair in zip(self.outputIsum, self.outputQsum) for s in pair]
+
+    def moving_sum(self, m, value, name):
+        """The registered sum of the last 4 values"""
+        domain = getattr(m.d, self.domain)
+        history = [Signal.like(value, name="{}_shift{}".format(name, i)) for i in range(4)]
+        total = Signal(range(4*self.width + 1), name="{}_sum".format(name))
+        domain += [a.eq(b) for a, b in zip(history, [value] + history[:-1])]
+        domain += total.eq(sum(history))
+        return total
+
+    def elaborate(self, platform):
+        m = Module()
+
+        domain = getattr(m.d, self.domain)
+        popcount = lambda bits, name: popcount_tree(m, domain, bits, self.chunks, self.levels_per_stage, name)
+
+        total = self.moving_sum(m, popcount(self.input, "count"), "count")
+
+        for i, (oscillatorI, oscillatorQ) in enumerate(self.oscillators):
+            loI, loQ = add_oscillators(m, oscillatorI, oscillatorQ, None, name="oscillator{}".format(i))
+            positiveI = self.moving_sum(m, popcount(loI & self.input, "ipsum{}".format(i)), "ipsum{}".format(i))
+            positiveQ = self.moving_sum(m, popcount(loQ & self.input, "qpsum{}".format(i)), "qpsum{}".format(i))
+            domain += [
+                self.outputIsum[i].eq(2*positiveI - total),
+                self.outputQsum[i].eq(2*positiveQ - total),
+            ]
+
+        return m
+
+    def model(self, words):
+        """(outputIsum, outputQsum) as (words, channels) arrays, exactly as make_callable returns them"""
+        words = np.concatenate([np.zeros(0, word_dtype(self.width))] + list(word_chunks([words]))).astype(word_dtype(self.width), copy=False)
+        history = np.zeros(self.latency + 3, np.int64)
+
+        total, _ = moving_sums(popcount(words), history)
+        outputs = []
+        for oscillatorI, oscillatorQ in self.oscillators:
+            loI, loQ = oscillator_models(oscillatorI, oscillatorQ, len(words), words.dtype)
+            outputs.append((2*moving_sums(popcount(loI & words), history)[0] - total,
+                2*moving_sums(popcount(loQ & words), history)[0] - total))
+        return np.array([o[0] for o in outputs]).T, np.array([o[1] for o in outputs]).T
+
+def test_mixer_modes():
+    from alldigitalradio.io.numpy import make_callable
+    from alldigitalradio.util import make_carrier, binarize, pack_mem
+
+    stimulus = pack_mem(binarize(make_carrier(freq=2.402e9, sample_rate=5e9, samples=20*100)), 20)
+    for mode in OSCILLATORS:
+        mixer = SummingMixer(sample_rate=5e9, frequency=2.402e9, max_error=10e3, cache=None, mode=mode)
+        mixer = make_callable(mixer)
+        out = np.array([mixer(int(word)) for word in stimulus])
+
+        # A carrier right at the LO frequency gives a steady, strong baseband output
+        magnitude = np.hypot(out[10:, 0], out[10:, 1])
+        assert magnitude.min() > 25
+
+def test_hopping_mixer():
+    from alldigitalradio.io.numpy import make_callable
+    import pytest
+    from alldigitalradio.util import make_carrier, binarize, pack_mem
+
+    frequencies = [2.402e9, 2.426e9, 2.48e9]
+    stimulus = pack_mem(binarize(make_carrier(freq=2.426e9, sample_rate=5e9, samples=20*200)), 20)
+
+    # Parked on a channel from reset, a hopping mixer matches a fixed one bit for bit
+    # (once the first few words of oscillator read-port startup have been summed away)
+    hopping = make_callable(SummingMixer(sample_rate=5e9, frequency=frequencies, max_error=10e3, cache=None))
+    fixed = make_callable(SummingMixer(sample_rate=5e9, frequency=frequencies[0], max_error=10e3, cache=None))
+    for i, word in enumerate(stimulus[:100]):
+        assert hopping(int(word), 0) == fixed(int(word)) or i < 12
+
+    # After hopping to the stimulus channel, the output settles to a strong steady tone
+    out = np.array([hopping(int(word), 1) for word in stimulus[100:]])
+    magnitude = np.hypot(out[20:, 0], out[20:, 1])
+    assert magnitude.min() > 25
+
+    with pytest.raises(ValueError):
+        SummingMixer(sample_rate=5e9, frequency=frequencies, max_error=10e3, cache=None).model(stimulus)
+
+def test_mixer_widths():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(0)
+    for width, split, levels_per_stage, mode in [
+            (20, 2, 1, 'rom'), (16, 4, 1, 'dds'), (32, 4, None, 'rom'),
+            (40, 5, 2, 'rom'), (64, 8, 1, 'dds'), (20, 1, 1, 'rom')]:
+        # A DC LO has words that are all ones or all zeros, which along with all-ones
+        # input drives the popcounts and sums to full scale
+        for frequency in [2.402e9, 0]:
+            mixer = SummingMixer(sample_rate=5e9, frequency=frequency, max_error=10e3, cache=None, width=width,
+                split=split, levels_per_stage=levels_per_stage, mode=mode)
+            stimulus = np.concatenate([
+                rng.integers(0, 2**width, 40, dtype=np.uint64),
+                np.full(40, 2**width - 1, dtype=np.uint64)])
+
+            expectedI, expectedQ = mixer.model(stimulus)
+            mixer_callable = make_callable(mixer)
+            for i, word in enumerate(stimulus):
+                assert mixer_callable(int(word)) == [expectedI[i], expectedQ[i]], \
+                    "Mismatch at word {} for width {}".format(i, width)
+
+            if frequency == 0:
+                assert np.abs(expectedI).max() == 4*width
+                assert np.abs(expectedQ).max() == 4*width
+
+def test_mixer_model():
+    from alldigitalradio.io.numpy import make_callable
+    from alldigitalradio.util import make_carrier, binarize, PackedBits
+
+    rng = np.random.default_rng(1)
+    samples = 20*400
+    noisy = binarize(make_carrier(freq=2.4025e9, sample_rate=5e9, samples=samples) + rng.standard_normal(samples))
+    stimuli = {
+        'random': PackedBits.from_bits(rng.integers(0, 2, samples)),
+        'carrier': PackedBits.from_bits(noisy),
+    }
+
+    for mode in OSCILLATORS:
+        mixer = SummingMixer(sample_rate=5e9, frequency=2.402e9, max_error=10e3, cache=None, mode=mode)
+        for name, stimulus in stimuli.items():
+            expectedI, expectedQ = mixer.model(stimulus)
+
+            mixer_callable = make_callable(mixer)
+            for i, word in enumerate(stimulus):
+                assert mixer_callable(int(word)) == [expectedI[i], expectedQ[i]], \
+                    "Mismatch at word {} of {} stimulus in {} mode".format(i, name, mode)
+
+            # Streaming through uneven chunks picks up exactly where the last one left off
+            pieces = [stimulus[:20*7], stimulus[20*7:20*250], stimulus[20*250:]]
+            streamed = list(mixer.stream_model(pieces, chunk_words=64))
+            assert (np.concatenate([o[0] for o in streamed]) == expectedI).all()
+            assert (np.concatenate([o[1] for o in streamed]) == expectedQ).all()
+
+def test_decimating_mixer():
+    from alldigitalradio.io.numpy import make_callable
+    from nmigen.sim import Simulator, Tick
+
+    stimulus = np.random.default_rng(2).integers(0, 1 << 20, 80).astype(np.uint32)
+    for split in [2, 4]:
+        mixer = SummingMixer(sample_rate=5e9, frequency=2.402e9, max_error=10e3, cache=None, split=split, decimate=True, slowdomain=None)
+        expectedI, expectedQ = mixer.model(stimulus)
+        mixer_callable = make_callable(mixer)
+        out = np.array([mixer_callable(int(word)) for word in stimulus])
+
+        valid = np.nonzero(out[:, 2])[0]
+        assert list(valid) == [k for k in range(1, len(stimulus)) if k % 4 == mixer.valid_phase()]
+        for k in valid:
+            assert out[k, 0] == expectedI[k] and out[k, 1] == expectedQ[k]
+            assert (out[k:k + 4, :2] == out[k, :2]).all()
+
+    assert resource_usage(mixer)['registers'] < resource_usage(SummingMixer(sample_rate=5e9,
+        frequency=2.402e9, max_error=10e3, cache=None, split=4))['registers']
+    assert not hasattr(mixer, 'outputIshift')
+
+    # In a divided clock domain, every slow clock picks up the next decimated sample
+    mixer = SummingMixer(sample_rate=5e9, frequency=2.402e9, max_error=10e3, cache=None, decimate=True)
+    expectedI, _ = mixer.model(stimulus)
+    sim = Simulator(mixer)
+    sim.add_clock(1e-6, domain="sync")
+    sim.add_clock(4e-6, domain="rxdiv4")
+    slow = []
+
+    def feed():
+        for word in stimulus:
+            yield mixer.input.eq(int(word))
+            yield Tick()
+
+    def sample():
+        for _ in range(len(stimulus)//4 - 1):
+            yield Tick("rxdiv4")
+            slow.append((yield mixer.outputIslow))
+
+    sim.add_process(feed)
+    sim.add_process(sample)
+    sim.run()
+
+    assert slow[1:] == list(expectedI[mixer.valid_phase()::4][:len(slow) - 1])
+
+def test_mixer_bank():
+    from alldigitalradio.io.numpy import make_callable
+    from alldigitalradio.util import make_carrier, binarize, pack_mem
+
+    frequencies = [2.402e9, 2.426e9, 2.48e9]
+    bank = MixerBank(sample_rate=5e9, frequencies=frequencies, max_error=10e3, cache=None)
+    mixers = [SummingMixer(sample_rate=5e9, frequency=f, max_error=10e3, cache=None) for f in frequencies]
+
+    noise = np.random.default_rng(0).standard_normal(20*300)
+    stimulus = pack_mem(binarize(make_carrier(freq=2.426e9, sample_rate=5e9, samples=20*300) + noise), 20)
+
+    # Every channel matches what a separate mixer would produce
+    bankI, bankQ = bank.model(stimulus)
+    for i, mixer in enumerate(mixers):
+        mixerI, mixerQ = mixer.model(stimulus)
+        assert (bankI[:, i] == mixerI).all() and (bankQ[:, i] == mixerQ).all()
+
+    bank_callable = make_callable(bank)
+    for i, word in enumerate(stimulus[:100]):
+        out = bank_callable(int(word))
+        assert out == [v for pair in zip(bankI[i], bankQ[i]) for v in pair], "Mismatch at {}".format(i)
+
+    bank_usage = resource_usage(bank)
+    mixer_usage = [resource_usage(m) for m in mixers]
+    print("Bank: {} registers, {} memory bits, {} popcount inputs".format(
+        bank_usage['registers'], bank_usage['memory_bits'], bank.popcount_bits))
+    print("Separate mixers: {} registers, {} memory bits, {} popcount inputs".format(
+        sum(u['registers'] for u in mixer_usage), sum(u['memory_bits'] for u in mixer_usage),
+        sum(m.popcount_bits for m in mixers)))
+    assert bank_usage['registers'] < sum(u['registers'] for u in mixer_usage)
+    assert bank_usage['memory_bits'] == sum(u['memory_bits'] for u in mixer_usage)
+    assert bank.popcount_bits < sum(m.popcount_bits for m in mixers)
+
+if __name__ == '__main__':
+    import time
+    from alldigitalradio.io.numpy import make_callable
+
+    mixer = SummingMixer(sample_rate=5e9, frequency=2.402e9, max_error=10e3)
+    words = np.random.default_rng(0).integers(0, 1 << 20, 10*1000*1000).astype(np.uint32)
+
+    start = time.time()
+    mixer_callable = make_callable(mixer)
+    for word in words[:2000]:
+        mixer_callable(int(word))
+    print("{:>12}: {:12.0f} words/s".format("simulation", 2000/(time.time() - start)))
+
+    start = time.time()
+    for _ in mixer.stream_model(words):
+        pass
+    print("{:>12}: {:12.0f} words/s".format("model", len(words)/(time.time() - start)))
@@ -1,15 +1,74 @@
+import math
+from fractions import Fraction
+
 import numpy as np
 from nmigen import *
 from nmigen.sim import Simulator
 from alldigitalradio.util import (
     binarize,
     make_carrier,
-    pack_mem
+    make_periodic_carrier,
+    pack_mem,
+    unpack_mem
 )
+from alldigitalradio.cache import PatternCache, pattern_cache
+from alldigitalradio.resources import resource_usage
 import json
 
+def simplest_fraction_between(lo: Fraction, hi: Fraction):
+    """The fraction with the smallest denominator strictly between lo and hi, found by
+       walking the continued fraction expansions of both ends until they diverge"""
+    n = math.floor(lo)
+    if n + 1 < hi:
+        return Fraction(n + 1)
+    if lo == n:
+        return n + Fraction(1, math.floor(1/(hi - n)) + 1)
+    return n + 1/simplest_fraction_between(1/(hi - n), 1/(lo - n))
+
+def find_period(sample_rate: float, frequency: float, max_error: float, width: int):
+    """Finds the shortest pattern (a whole number of `width`-sample words) that repeats
+       a whole number of carrier cycles with a frequency strictly within max_error of the
+       goal. Returns (cycles, samples, exact realized frequency as a Fraction)."""
+    sample_rate = Fraction(sample_rate)
+    cycles_per_word = Fraction(frequency)*width/sample_rate
+    slack = Fraction(max_error)*width/sample_rate
+
+    # cycles/words is the realized cycles per word, so the fewest words is the smallest denominator
+    ratio = simplest_fraction_between(cycles_per_word - slack, cycles_per_word + slack)
+    cycles, words = ratio.numerator, ratio.denominator
+    return cycles, words*width, ratio*sample_rate/width
+
+def make_pattern(sample_rate: float, frequency: float, max_error: float, width: int, phase: float=0, cache=pattern_cache):
+    """Returns (packed words of one period, exact realized frequency), from the cache if possible"""
+    key = (float(sample_rate), float(frequency), float(max_error), int(width), float(phase))
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        return cached['pattern'], Fraction(str(cached['exact_frequency']))
+
+    cycles, samples, exact_frequency = find_period(sample_rate, frequency, max_error, width)
+    packed_pattern = pack_mem(make_periodic_carrier(cycles, samples, phase=phase), width)
+
+    if cache is not None:
+        cache.put(key, pattern=packed_pattern, exact_frequency=str(exact_frequency))
+    return packed_pattern, exact_frequency
+
+def looping_read_port(m, pattern, domain):
+    """Adds a read port on the `pattern` Memory to m, addressed by a counter that loops
+       through every word of it, and returns the port and the counter"""
+    m.submodules.pattern_rport = rport = pattern.read_port(domain=domain)
+    counter = Signal(range(pattern.depth + 1))
+
+    sync = getattr(m.d, domain)
+    with m.If(counter == (pattern.depth - 1)):
+        sync += counter.eq(0)
+    with m.Else():
+        sync += counter.eq(counter + 1)
+
+    m.d.comb += rport.addr.eq(counter)
+    return rport, counter
+
 class OneBitFixedOscillator(Elaboratable):
-    def __init__(self, sample_rate: float, frequency: float, max_error: float, width: int, phase: float=0, domain: str="sync"):
+    def __init__(self, sample_rate: float, frequency: float, max_error: float, width: int, phase: float=0, domain: str="sync", cache=pattern_cache):
         self.sample_rate = sample_rate
         self.frequency = frequency
         self.max_error = max_error
@@ -17,44 +76,209 @@ class OneBitFixedOscillator(Elaboratable):
         self.domain = domain
         self.output = Signal(width)
 
-        samples = width
-        while True:
-             period_error = np.round(samples*frequency/sample_rate)
-             realized_frequency = period_error*sample_rate/samples
-             if np.abs(realized_frequency - frequency) < max_error:
-                 break
-             samples += width
+        self.packed_pattern, self.exact_frequency = make_pattern(sample_rate, frequency, max_error, width, phase, cache)
+        self.realized_frequency = float(self.exact_frequency)
+        self.pattern_words = len(self.packed_pattern)
+        samples = self.pattern_words*width
 
-        pattern = binarize(make_carrier(realized_frequency, sample_rate, samples, phase=phase))
+        print("Goal Frequency: {}, actual: {}, period: {}, len: {}".format(frequency, self.realized_frequency, samples, len(self.packed_pattern)))
+
+    def inputs(self):
+        return []
+
+    def outputs(self):
+        return [self.output]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pattern = Memory(width=self.width, depth=len(self.packed_pattern), init=self.packed_pattern)
+        rport, self.counter = looping_read_port(m, pattern, self.domain)
+
+        domain = getattr(m.d, self.domain)
+        domain += [
+            self.output.eq(rport.data)
+        ]
+
+        return m
 
-        self.packed_pattern = pack_mem(pattern, width)
-        self.realized_frequency = realized_frequency
+    def model(self, words: int, start: int=0):
+        """`words` values of output (as seen after each clock) from the `start`th on, bit for bit"""
+        return rom_model(self.packed_pattern, words, start=start)
+
+def rom_model(pattern: np.ndarray, words: int, ahead: int=0, start: int=0):
+    """What a registered read of a looping ROM address counter produces after each clock
+       (from the `start`th clock on): the read port's address latch starts at 0, so the
+       first word shows up twice"""
+    clock = np.arange(start, start + words)
+    index = np.where(clock == 0, 0, np.maximum(clock - 1, 0) + ahead)
+    return np.asarray(pattern)[index % len(pattern)]
+
+class OneBitIQOscillator(Elaboratable):
+    """
+    The in-phase and quadrature (pi/2 delayed) outputs of a pair of OneBitFixedOscillators,
+    but from a single ROM. The quadrature pattern is the in-phase pattern delayed by
+    quarter_offset samples, so a second read port runs that many samples ahead and, when
+    the offset isn't a whole number of words, the word it reads is spliced with the one
+    before it. Some frequencies never land a sample exactly a quarter cycle apart (shared
+    is then False) and those fall back to a second ROM with the quadrature pattern.
+    """
+    def __init__(self, sample_rate: float, frequency: float, max_error: float, width: int, domain: str="sync", cache=pattern_cache):
+        self.sample_rate = sample_rate
+        self.frequency = frequency
+        self.max_error = max_error
+        self.width = width
+        self.domain = domain
+        self.outputI = Signal(width)
+        self.outputQ = Signal(width)
+
+        self.packed_pattern, self.exact_frequency = make_pattern(sample_rate, frequency, max_error, width, 0, cache)
+        self.realized_frequency = float(self.exact_frequency)
         self.pattern_words = len(self.packed_pattern)
 
-        print("Goal Frequency: {}, actual: {}, period: {}, len: {}".format(frequency, realized_frequency, samples, len(self.packed_pattern)))
+        samples = self.pattern_words*width
+        cycles = int(self.exact_frequency*samples/Fraction(sample_rate))
+
+        # Q[n] == I[n - s] needs cycles*s/samples to be exactly a quarter turn
+        s = np.arange(samples, dtype=np.int64)
+        shifts = np.nonzero((4*((cycles*s) % samples)) == samples)[0]
+        self.shared = len(shifts) > 0
+        if self.shared:
+            self.quarter_offset = int(shifts[0])
+            self.word_offset, self.bit_offset = divmod(-self.quarter_offset % samples, width)
+            self.packed_patternQ = None
+        else:
+            self.quarter_offset = None
+            self.packed_patternQ, _ = make_pattern(sample_rate, frequency, max_error, width, np.pi/2, cache)
 
     def inputs(self):
         return []
 
+    def outputs(self):
+        return [self.outputI, self.outputQ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        words = self.pattern_words
+        pattern = Memory(width=self.width, depth=words, init=self.packed_pattern)
+        rport, counter = looping_read_port(m, pattern, self.domain)
+        self.counter = counter
+
+        domain = getattr(m.d, self.domain)
+        domain += self.outputI.eq(rport.data)
+
+        if self.shared:
+            # Read one word past the quadrature word so that the previous read (held in
+            # last) and this one contain all of the bits we need to splice together
+            m.submodules.quadrature_rport = qport = pattern.read_port(domain=self.domain)
+            last = Signal(self.width)
+            ahead = (self.word_offset + 1) % words
+
+            with m.If(counter >= words - ahead):
+                m.d.comb += qport.addr.eq(counter - (words - ahead))
+            with m.Else():
+                m.d.comb += qport.addr.eq(counter + ahead)
+
+            domain += [
+                last.eq(qport.data),
+                self.outputQ.eq(Cat(last[self.bit_offset:], qport.data[:self.bit_offset]))
+            ]
+        else:
+            patternQ = Memory(width=self.width, depth=words, init=self.packed_patternQ)
+            m.submodules.quadrature_rport = qport = patternQ.read_port(domain=self.domain)
+            m.d.comb += qport.addr.eq(counter)
+            domain += self.outputQ.eq(qport.data)
+
+        return m
+
+    def model(self, words: int, start: int=0):
+        """`words` values of (outputI, outputQ) as seen after each clock from the `start`th
+           on, bit for bit"""
+        outputI = rom_model(self.packed_pattern, words, start=start)
+        if not self.shared:
+            return outputI, rom_model(self.packed_patternQ, words, start=start)
+
+        # The quadrature port's data and the previous read, spliced together
+        ahead = (self.word_offset + 1) % self.pattern_words
+        if start == 0:
+            data = rom_model(self.packed_pattern, words, ahead=ahead)
+            last = np.concatenate([np.zeros(1, data.dtype), data[:-1]])
+        else:
+            data = rom_model(self.packed_pattern, words + 1, ahead=ahead, start=start - 1)
+            data, last = data[1:], data[:-1]
+        shift = data.dtype.type(self.bit_offset)
+        mask = data.dtype.type((1 << self.width) - 1)
+        return outputI, (last >> shift) | ((data << data.dtype.type(self.width - self.bit_offset)) & mask)
+
+class OneBitMultiFrequencyOscillator(Elaboratable):
+    """
+    Like OneBitFixedOscillator but for several frequencies at once, i.e. to follow a
+    channel hopping sequence. The patterns for every frequency are packed back to back
+    into one memory, with a base address and length per channel, and `select` picks the
+    channel at runtime. A change of `select` restarts the new channel's pattern from its
+    start and shows up on `output` switch_latency cycles later.
+    """
+    def __init__(self, sample_rate: float, frequencies: list, max_error: float, width: int, phase: float=0, domain: str="sync", cache=pattern_cache):
+        self.sample_rate = sample_rate
+        self.frequencies = frequencies
+        self.max_error = max_error
+        self.width = width
+        self.domain = domain
+
+        self.select = Signal(range(len(frequencies)))
+        self.output = Signal(width)
+
+        self.patterns = []
+        self.exact_frequencies = []
+        for frequency in frequencies:
+            pattern, exact_frequency = make_pattern(sample_rate, frequency, max_error, width, phase, cache)
+            self.patterns.append(pattern)
+            self.exact_frequencies.append(exact_frequency)
+        self.realized_frequencies = [float(f) for f in self.exact_frequencies]
+
+        self.lengths = [len(p) for p in self.patterns]
+        self.bases = [sum(self.lengths[:i]) for i in range(len(self.patterns))]
+        self.packed_pattern = np.concatenate(self.patterns)
+        self.pattern_words = len(self.packed_pattern)
+
+        # select register -> channel/offset registers -> memory read -> output register
+        self.switch_latency = 4
+
+    def inputs(self):
+        return [self.select]
+
     def outputs(self):
         return [self.output]
 
     def elaborate(self, platform):
         m = Module()
 
-        pattern = Memory(width=self.width, depth=len(self.packed_pattern), init=self.packed_pattern)
+        pattern = Memory(width=self.width, depth=self.pattern_words, init=self.packed_pattern)
         m.submodules.pattern_rport = rport = pattern.read_port(domain=self.domain)
 
-        self.counter = counter = Signal(range(len(self.packed_pattern) + 1))
+        bases = Array([Const(b, range(self.pattern_words + 1)) for b in self.bases])
+        lasts = Array([Const(l - 1, range(max(self.lengths) + 1)) for l in self.lengths])
+
+        select = Signal.like(self.select)
+        self.channel = channel = Signal.like(self.select)
+        self.counter = counter = Signal(range(max(self.lengths) + 1))
 
         domain = getattr(m.d, self.domain)
-        with m.If(counter == (len(self.packed_pattern) - 1)):
-            domain += counter.eq(0) 
+        domain += select.eq(self.select)
+
+        with m.If(select != channel):
+            domain += [
+                channel.eq(select),
+                counter.eq(0)
+            ]
+        with m.Elif(counter == lasts[channel]):
+            domain += counter.eq(0)
         with m.Else():
-            domain += counter.eq(counter + 1) 
+            domain += counter.eq(counter + 1)
 
         m.d.comb += [
-            rport.addr.eq(counter)
+            rport.addr.eq(bases[channel] + counter)
         ]
 
         domain += [
@@ -63,29 +287,100 @@ class OneBitFixedOscillator(Elaboratable):
 
         return m
 
+class OneBitDDSOscillator(Elaboratable):
+    """
+    A drop-in alternative to OneBitFixedOscillator that computes each word from a phase
+    accumulator rather than reading it from a ROM of the whole period. Every clock the
+    accumulator advances by width phase steps and each output bit is the sign of the
+    carrier at accumulator + i*step, looked up from the top two phase bits (i.e. which
+    quadrant the phase is in). The accumulator is made just wide enough to meet
+    max_error, so the cost is a few adders and registers regardless of how tight the
+    frequency error is.
+    """
+    # Sign of cos() for phases in each quadrant, indexed by the top two phase bits
+    QUADRANT_SIGNS = [1, 0, 0, 1]
+
+    def __init__(self, sample_rate: float, frequency: float, max_error: float, width: int, phase: float=0, domain: str="sync"):
+        self.sample_rate = sample_rate
+        self.frequency = frequency
+        self.max_error = max_error
+        self.width = width
+        self.domain = domain
+        self.output = Signal(width)
+
+        self.phase_bits = 2
+        while True:
+            self.step = int(round(Fraction(frequency)/Fraction(sample_rate)*2**self.phase_bits)) % 2**self.phase_bits
+            self.exact_frequency = Fraction(self.step*Fraction(sample_rate), 2**self.phase_bits)
+            if abs(self.exact_frequency - Fraction(frequency)) < Fraction(max_error):
+                break
+            self.phase_bits += 1
+
+        self.realized_frequency = float(self.exact_frequency)
+        self.initial_phase = -int(round(phase/(2*np.pi)*2**self.phase_bits)) % 2**self.phase_bits
+
+    def inputs(self):
+        return []
+
+    def outputs(self):
+        return [self.output]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        self.accumulator = accumulator = Signal(self.phase_bits, reset=self.initial_phase)
+        mask = 2**self.phase_bits - 1
+        table = Const(sum(b << i for i, b in enumerate(self.QUADRANT_SIGNS)), 4)
+
+        bits = []
+        for i in range(self.width):
+            phase = Signal(self.phase_bits, name="phase{}".format(i))
+            m.d.comb += phase.eq(accumulator + ((i*self.step) & mask))
+            bits.append(table.bit_select(phase[-2:], 1))
+
+        domain = getattr(m.d, self.domain)
+        domain += [
+            accumulator.eq(accumulator + ((self.width*self.step) & mask)),
+            self.output.eq(Cat(*bits))
+        ]
+
+        return m
+
+    def model(self, words: int, start: int=0):
+        """`words` values of output from the `start`th on, bit for bit"""
+        mask = np.uint64(2**self.phase_bits - 1)
+        k = np.arange(start, start + words, dtype=np.uint64).reshape(-1, 1)
+        i = np.arange(self.width, dtype=np.uint64).reshape(1, -1)
+        phase = (np.uint64(self.initial_phase) + k*np.uint64(self.width*self.step) + i*np.uint64(self.step)) & mask
+        quadrant = (phase >> np.uint64(self.phase_bits - 2)).astype(np.int64)
+        return pack_mem(np.array(self.QUADRANT_SIGNS)[quadrant].reshape(-1), self.width)
+
 def test_frequency_generation():
     """This creates an oscillator with a frequency error that meets a given spec and then
-       verifies that it actually loops through everything. Note that below a certain error
-       level, we start to get assorted floating point differences that mean that this test
-       fails against even the "realized frequency" reference"""
+       verifies that it actually loops through everything. The pattern is built with exact
+       phase arithmetic, so it has to match the reference for every period, not just the first."""
     
     freq = 2.4*1e9
     sample_rate = 5*1e9
     error = 0.0001*1e6 # 50ppm allowable frequency error, not 
 
-    m = OneBitFixedOscillator(sample_rate=sample_rate, frequency=freq, max_error=error, width=20, domain='sync')
+    m = OneBitFixedOscillator(sample_rate=sample_rate, frequency=freq, max_error=error, width=20, domain='sync', cache=None)
     sim = Simulator(m)
     sim.add_clock(1e-6, domain="sync")
 
     assert np.abs(m.realized_frequency - freq) < error
     samples = m.pattern_words*10
 
-    ref = binarize(make_carrier(sample_rate=sample_rate, freq=m.realized_frequency, samples=samples*20))
+    cycles = m.exact_frequency*m.pattern_words*20/Fraction(sample_rate)
+    assert cycles.denominator == 1
+    ref = np.tile(make_periodic_carrier(int(cycles), m.pattern_words*20), 10)
     ref = pack_mem(ref, 20)
 
     output = np.zeros((samples,), dtype=np.uint32)
 
     def process():
+        # The memory read and the output register add one word of latency
+        yield
         for i in range(samples):
             yield
             result = yield m.output
@@ -98,4 +393,158 @@ def test_frequency_generation():
     sim.add_sync_process(process)
     
     with sim.write_vcd("nco.vcd"):
-        sim.run()
\ No newline at end of file
+        sim.run()
+
+def test_period_search():
+    def brute_force(sample_rate, frequency, max_error, width):
+        # The original float search (which is only trustworthy for loose errors)
+        samples = width
+        while True:
+             period_error = np.round(samples*frequency/sample_rate)
+             realized_frequency = period_error*sample_rate/samples
+             if np.abs(realized_frequency - frequency) < max_error:
+                 return samples
+             samples += width
+
+    for frequency in [2.4e9, 2.402e9, 2.426e9, 2.48e9, 1.25e9, 913.7e6]:
+        for max_error in [1e6, 100e3, 10e3]:
+            cycles, samples, exact = find_period(5e9, frequency, max_error, 20)
+            assert samples == brute_force(5e9, frequency, max_error, 20)
+            assert abs(exact - Fraction(frequency)) < max_error
+            assert exact == Fraction(cycles)*Fraction(5e9)/samples
+
+    # Tight bounds that would take the float loop millions of iterations are instant
+    cycles, samples, exact = find_period(5e9, 2.402e9 + 0.123, 1e-3, 20)
+    assert abs(exact - Fraction(2.402e9 + 0.123)) < Fraction(1e-3)
+    assert samples % 20 == 0
+
+def test_periodic_carrier():
+    # Away from exact zero crossings this agrees with the float carrier
+    cycles, samples, exact = find_period(5e9, 2.402e9, 10e3, 20)
+    for phase in [0, np.pi/2, 0.3]:
+        exact_pattern = make_periodic_carrier(cycles, samples, phase=phase)
+        carrier = make_carrier(float(exact), 5e9, samples, phase=phase)
+        clear = np.abs(carrier) > 1e-6
+        assert (exact_pattern[clear] == binarize(carrier)[clear]).all()
+
+def test_pattern_caching(tmp_path):
+    cache = PatternCache(path=str(tmp_path))
+    args = dict(sample_rate=5e9, frequency=2.402e9, max_error=10e3, width=20, phase=np.pi/2)
+
+    first = OneBitFixedOscillator(cache=cache, **args)
+    assert (cache.hits, cache.misses) == (0, 1)
+    second = OneBitFixedOscillator(cache=cache, **args)
+    assert (cache.hits, cache.misses) == (1, 1)
+    from_disk = OneBitFixedOscillator(cache=PatternCache(path=str(tmp_path)), **args)
+
+    uncached = OneBitFixedOscillator(cache=None, **args)
+    for osc in [first, second, from_disk]:
+        assert osc.exact_frequency == uncached.exact_frequency
+        assert (osc.packed_pattern == uncached.packed_pattern).all()
+
+def test_dds_oscillator():
+    for freq, phase in [(2.402e9, 0), (2.402e9, np.pi/2), (2.48e9, 0), (913.7e6, 0.3)]:
+        m = OneBitDDSOscillator(sample_rate=5e9, frequency=freq, max_error=1e3, width=20, phase=phase)
+        assert abs(m.exact_frequency - Fraction(freq)) < 1e3
+
+        words = 200
+        ref = m.model(words)
+        sim = Simulator(m)
+        sim.add_clock(1e-6, domain="sync")
+
+        def process():
+            for i in range(words):
+                yield
+                result = yield m.output
+                assert result == ref[i], "At {} got {} but expected {}".format(i, bin(result), bin(ref[i]))
+
+        sim.add_sync_process(process)
+        sim.run()
+
+        # The model agrees with the ideal carrier everywhere except right at zero crossings
+        carrier = make_carrier(m.realized_frequency, 5e9, words*20, phase=phase)
+        clear = np.abs(carrier) > 1e-3
+        assert (unpack_mem(ref, 20)[clear] == (carrier[clear] > 0)).all()
+
+def test_dds_memory():
+    """The ROM grows with the accuracy we ask for, the DDS just gets a few bits wider"""
+    for max_error in [1e6, 10e3, 100]:
+        rom = OneBitFixedOscillator(sample_rate=5e9, frequency=2.402e9 + 1234, max_error=max_error, width=20, cache=None)
+        dds = OneBitDDSOscillator(sample_rate=5e9, frequency=2.402e9 + 1234, max_error=max_error, width=20)
+        rom_usage = resource_usage(rom)
+        dds_usage = resource_usage(dds)
+        print("max_error {}: ROM {} memory bits + {} registers, DDS {} memory bits + {} registers".format(
+            max_error, rom_usage['memory_bits'], rom_usage['registers'], dds_usage['memory_bits'], dds_usage['registers']))
+        assert dds_usage['memory_bits'] == 0
+        assert dds_usage['registers'] == dds.phase_bits + 20
+
+def test_multi_frequency_oscillator():
+    frequencies = [2.402e9, 2.426e9, 2.48e9]
+    m = OneBitMultiFrequencyOscillator(sample_rate=5e9, frequencies=frequencies, max_error=100e3, width=20, cache=None)
+    sim = Simulator(m)
+    sim.add_clock(1e-6, domain="sync")
+
+    hops = [(0, 0), (300, 2), (520, 1), (700, 1), (800, 0)]
+
+    def process():
+        output = []
+        for i in range(1000):
+            for when, channel in hops:
+                if when == i:
+                    yield m.select.eq(channel)
+            yield
+            output.append((yield m.output))
+
+        for (start, channel), (end, _) in zip(hops, hops[1:] + [(1000, None)]):
+            # Each hop restarts that channel's pattern after switch_latency cycles
+            first = start + m.switch_latency if start > 0 else 1
+            pattern = m.patterns[channel]
+            expected = [pattern[i % len(pattern)] for i in range(end - first)]
+            if start == 700:
+                continue # re-selecting the same channel doesn't restart it
+            assert output[first:end] == expected, "channel {} at {}".format(channel, start)
+
+    sim.add_sync_process(process)
+    sim.run()
+
+def test_iq_oscillator():
+    # All but 2.4 GHz have a sample exactly a quarter cycle later, and for 62.5 MHz it's a whole word later
+    for freq, shared in [(2.402e9, True), (2.426e9, True), (2.45e9, True), (1.25e9, True), (62.5e6, True), (2.4e9, False)]:
+        args = dict(sample_rate=5e9, frequency=freq, max_error=10e3, width=20, cache=None)
+        iq = OneBitIQOscillator(**args)
+        i = OneBitFixedOscillator(**args)
+        q = OneBitFixedOscillator(phase=np.pi/2, **args)
+        assert iq.shared == shared
+
+        class Both(Elaboratable):
+            def elaborate(self, platform):
+                m = Module()
+                m.submodules.iq = iq
+                m.submodules.i = i
+                m.submodules.q = q
+                return m
+
+        sim = Simulator(Both())
+        sim.add_clock(1e-6, domain="sync")
+        modelI, modelQ = iq.model(2 + 3*iq.pattern_words)
+
+        def process():
+            # The models match from reset, but skip the first couple of words while the
+            # read ports fill before comparing against the separate oscillators
+            for n in range(2):
+                yield
+                assert (yield iq.outputI) == modelI[n]
+                assert (yield iq.outputQ) == modelQ[n]
+                assert (yield i.output) == i.model(2)[n]
+            for n in range(3*iq.pattern_words):
+                yield
+                assert (yield iq.outputI) == (yield i.output), "I mismatch at {} for {}".format(n, freq)
+                assert (yield iq.outputQ) == (yield q.output), "Q mismatch at {} for {}".format(n, freq)
+                assert (yield iq.outputI) == modelI[n + 2]
+                assert (yield iq.outputQ) == modelQ[n + 2]
+
+        sim.add_sync_process(process)
+        sim.run()
+
+        separate = resource_usage(i)['memory_bits'] + resource_usage(q)['memory_bits']
+        assert resource_usage(iq)['memory_bits'] == (separate//2 if shared else separate)
@@ -0,0 +1,30 @@
+from nmigen.hdl.ir import Fragment, Instance
+
+def resource_usage(elaboratable, platform=None):
+    """
+    Elaborates a design and tallies up what it will cost in the fabric. Registers are
+    the bits of every signal driven from a clock domain and memory_bits is the total
+    size of every Memory that is read or written. This is meant for comparing
+    implementations against each other rather than predicting exact utilization.
+    """
+    usage = {'registers': 0, 'memories': 0, 'memory_bits': 0}
+    memories = set()
+
+    def walk(fragment):
+        if isinstance(fragment, Instance):
+            memory = fragment.parameters.get('MEMID')
+            if memory is not None and id(memory) not in memories:
+                memories.add(id(memory))
+                usage['memories'] += 1
+                usage['memory_bits'] += memory.width*memory.depth
+            return
+
+        for domain, signals in fragment.drivers.items():
+            if domain is not None:
+                usage['registers'] += sum(len(s) for s in signals)
+
+        for subfragment, _ in fragment.subfragments:
+            walk(subfragment)
+
+    walk(Fragment.get(elaboratable, platform))
+    return usage
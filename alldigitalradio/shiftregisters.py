@@ -2,6 +2,8 @@ from nmigen import *
 from nmigen.sim import Simulator
 import numpy as np
 
+from alldigitalradio.util import PackedBits
+
 class LinearFeedbackShiftRegister(Elaboratable):
     def __init__(self, taps=[0, 4, 7], init=(37 | (1 << 6))):
         self.width = max(taps)
@@ -96,19 +98,23 @@ def test_crc():
     with sim.write_vcd("crc.vcd"):
         sim.run()
 
-def prbs(n=0, taps=[]):
+def prbs(n=0, taps=[], width=None):
+    """Returns one period of the sequence as a list, or as a PackedBits of `width`-bit
+       words if a width is given"""
     state = [1]*n
     shift = lambda s: [sum([s[i] for i in taps]) % 2] + s[0:-1]
     out = []
     for i in range(2**n - 1):
         out.append(state[-1])
         state = shift(state)
+    if width is not None:
+        return PackedBits.from_bits(out, width)
     return out
 
-prbs4 = lambda: prbs(n=4, taps=[2,3])
-prbs9 = lambda: prbs(n=9, taps=[4,8])
-prbs11 = lambda: prbs(n=11, taps=[8,10])
-prbs13 = lambda: prbs(n=13, taps=[7,10,11,12])
-prbs14 = lambda: prbs(n=14, taps=[1,11,12,13])
-prbs15 = lambda: prbs(n=15, taps=[13,14])
-prbs23 = lambda: prbs(n=23, taps=[17,22])
\ No newline at end of file
+prbs4 = lambda width=None: prbs(n=4, taps=[2,3], width=width)
+prbs9 = lambda width=None: prbs(n=9, taps=[4,8], width=width)
+prbs11 = lambda width=None: prbs(n=11, taps=[8,10], width=width)
+prbs13 = lambda width=None: prbs(n=13, taps=[7,10,11,12], width=width)
+prbs14 = lambda width=None: prbs(n=14, taps=[1,11,12,13], width=width)
+prbs15 = lambda width=None: prbs(n=15, taps=[13,14], width=width)
+prbs23 = lambda width=None: prbs(n=23, taps=[17,22], width=width)
\ No newline at end of file
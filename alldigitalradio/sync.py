@@ -1,15 +1,34 @@
+from fractions import Fraction
+from math import ceil, floor
+
 from nmigen import *
 from nmigen.sim import Simulator
 import numpy as np
 
+from alldigitalradio.util import PackedBits, clock_enabled, popcount_tree, split_chunks, tree_stages
+
+def tap_positions(length, interval):
+    """Where each of a pattern's bits is looked for in a shift register, interval + 1
+       samples apart. The interval can be fractional (i.e. a Fraction), in which case each
+       one is rounded to the nearest sample."""
+    return [int(floor(i*(interval + 1) + Fraction(1, 2))) for i in range(length)]
+
+def wrapping_add(value, amount, period):
+    """(value + amount) % period for a value in [0, period) and a constant amount in
+       (-period, period), with a compare rather than a divider"""
+    if amount < 0:
+        return Mux(value >= -amount, value + amount, value + amount + period)
+    return Mux(value >= period - amount, value + amount - period, value + amount)
+
 class Matcher(Elaboratable):
     def __init__(self, pattern, interval, domain="sync"):
         self.pattern = pattern
         self.interval = interval
         self.domain = domain
+        self.taps = tap_positions(len(pattern), interval)
 
         self.input = Signal()
-        self.shiftreg = Signal((len(pattern) - 1)*(interval + 1) + 1)
+        self.shiftreg = Signal(self.taps[-1] + 1)
         self.match = Signal()
 
         self.view = Signal(len(pattern))
@@ -26,21 +45,367 @@ class Matcher(Elaboratable):
         domain = getattr(m.d, self.domain)
         domain += self.shiftreg.eq(Cat(self.shiftreg[1:], self.input))
 
-        m.d.comb += self.view.eq(Cat([self.shiftreg[i*(self.interval + 1)] for i in range(len(self.pattern))]))
-        m.d.comb += self.match.eq(Cat([self.pattern[i] == self.shiftreg[i*(self.interval + 1)] for i in range(len(self.pattern))]).all())
+        m.d.comb += self.view.eq(Cat([self.shiftreg[tap] for tap in self.taps]))
+        m.d.comb += self.match.eq(Cat([self.pattern[i] == self.shiftreg[tap] for i, tap in enumerate(self.taps)]).all())
+
+        return m
+
+    def model(self, bits):
+        """match on each clock as make_callable returns it (so for the bits before it)"""
+        return model_match(self.pattern, self.interval, bits)
+
+class MemoryMatcher(Elaboratable):
+    """
+    A Matcher that only keeps the len(pattern) taps it compares in registers. Each tap is
+    the one after it delayed by another interval + 1 clocks, and those delays all go through
+    one circular buffer in a Memory (interval - 1 deep, one bit per tap) which can be put in
+    block or distributed RAM, so match is exactly what a Matcher's would be for a fraction
+    of the flip-flops. The interval has to be at least 2.
+    """
+    def __init__(self, pattern, interval, domain="sync"):
+        if interval < 2:
+            raise ValueError("MemoryMatcher needs an interval of at least 2, got {}".format(interval))
+        self.pattern = [int(bit) for bit in pattern]
+        self.interval = interval
+        self.domain = domain
+
+        self.input = Signal()
+        self.taps = Signal(len(pattern))
+        self.memory = Memory(width=max(len(pattern) - 1, 1), depth=interval - 1, init=[0]*(interval - 1))
+        self.addr = Signal(range(interval - 1))
+        self.match = Signal()
+
+        self.view = self.taps
+
+    def inputs(self):
+        return [self.input]
+
+    def outputs(self):
+        return [self.match, self.view]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        domain = getattr(m.d, self.domain)
+        m.submodules.rport = rport = self.memory.read_port(domain=self.domain, transparent=False)
+        m.submodules.wport = wport = self.memory.write_port(domain=self.domain)
+
+        # The newest tap is the input, and every other one is what the tap after it was
+        # interval + 1 clocks ago: interval - 1 in the buffer, plus the read port and tap
+        # registers
+        domain += self.taps[-1].eq(self.input)
+        if len(self.pattern) > 1:
+            domain += self.taps[:-1].eq(rport.data)
+        m.d.comb += [
+            rport.addr.eq(self.addr),
+            wport.addr.eq(self.addr),
+            wport.data.eq(self.taps[1:]),
+            wport.en.eq(1),
+        ]
+        domain += self.addr.eq(Mux(self.addr == self.interval - 2, 0, self.addr + 1))
+
+        m.d.comb += self.match.eq(Cat([self.taps[i] == bit for i, bit in enumerate(self.pattern)]).all())
+
+        return m
+
+    def model(self, bits):
+        """match on each clock as make_callable returns it (so for the bits before it)"""
+        return model_match(self.pattern, self.interval, bits)
+
+def model_windows(bits, length):
+    """bits (0/1 samples or a PackedBits) padded with the zeros that the shift register
+       starts out with, so that the window seen on clock t starts at index t"""
+    bits = bits.unpack() if isinstance(bits, PackedBits) else np.asarray(bits)
+    return np.concatenate([np.zeros(length, np.uint8), (bits > 0).astype(np.uint8)]), len(bits)
+
+def model_match(pattern, interval, bits):
+    """Matcher.match on each clock, checking only the positions still matching after each tap"""
+    taps = tap_positions(len(pattern), interval)
+    padded, n = model_windows(bits, taps[-1] + 1)
+    candidates = np.arange(n)
+    for tap, bit in zip(taps, pattern):
+        candidates = candidates[padded[candidates + tap] == bit]
+    match = np.zeros(n, dtype=bool)
+    match[candidates] = True
+    return match
+
+def model_score(pattern, interval, bits):
+    """The number of agreeing pattern bits in the window seen on each clock"""
+    taps = tap_positions(len(pattern), interval)
+    padded, n = model_windows(bits, taps[-1] + 1)
+    score = np.zeros(n, np.int32)
+    for tap, bit in zip(taps, pattern):
+        score += padded[tap:tap + n] == bit
+    return score
+
+class CorrelatingMatcher(Elaboratable):
+    """
+    A Matcher that tolerates bit errors: `score` is how many of the pattern's bits agree,
+    counted by a popcount tree pipelined like SummingMixer's (latency clocks behind what a
+    Matcher would see), and `match` is whether it's at least `threshold`, which can be
+    changed at runtime. While it matches, the best score seen is tracked, and
+    `peak_offset` is the number of clocks since the middle of the clocks at that score,
+    i.e. how far past the best alignment (the eye center) the input is.
+
+    With a period, `peak_phase` is also kept at (peak_offset*step) % period, stepping it
+    along with the counters peak_offset comes from, so that a phase can be loaded from it
+    without dividing.
+    """
+    def __init__(self, pattern, interval, threshold=None, chunk_bits=8, levels_per_stage=1, period=None, step=1, domain="sync"):
+        self.pattern = [int(bit) for bit in pattern]
+        self.interval = interval
+        self.domain = domain
+        self.taps = tap_positions(len(pattern), interval)
+        self.length = self.taps[-1] + 1
+
+        self.chunks = split_chunks(len(pattern), -(-len(pattern)//chunk_bits))
+        self.levels_per_stage = levels_per_stage
+        self.latency = 1 + tree_stages(len(self.chunks), levels_per_stage)
+
+        self.input = Signal()
+        self.threshold = Signal(range(len(pattern) + 1), reset=len(pattern) if threshold is None else threshold)
+        self.shiftreg = Signal(self.length)
+        self.score = Signal(range(len(pattern) + 1))
+        self.match = Signal()
+
+        self.peak = Signal(range(len(pattern) + 1))
+        self.since_peak = Signal(range(self.length + 1))
+        self.peak_width = Signal(range(self.length + 1))
+        self.peak_offset = Signal(range(self.length + 1))
+
+        self.period = period
+        self.step = step
+        if period is not None:
+            self.peak_phase = Signal(range(period))
+
+    def inputs(self):
+        return [self.input, self.threshold]
+
+    def outputs(self):
+        return [self.match, self.score, self.peak_offset]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        domain = getattr(m.d, self.domain)
+        domain += self.shiftreg.eq(Cat(self.shiftreg[1:], self.input))
+
+        agreement = Cat([self.shiftreg[tap] == bit for tap, bit in zip(self.taps, self.pattern)])
+        m.d.comb += [
+            self.score.eq(popcount_tree(m, domain, agreement, self.chunks, self.levels_per_stage, "agreement")),
+            self.match.eq(self.score >= self.threshold),
+            self.peak_offset.eq(self.since_peak - ((self.peak_width + 1) >> 1)),
+        ]
+
+        saturating = lambda counter: Mux(counter == self.length, counter, counter + 1)
+        with m.If(~self.match):
+            domain += [self.peak.eq(0), self.since_peak.eq(0), self.peak_width.eq(0)]
+            if self.period is not None:
+                domain += self.peak_phase.eq(0)
+        with m.Elif(self.score > self.peak):
+            domain += [self.peak.eq(self.score), self.since_peak.eq(1), self.peak_width.eq(0)]
+            if self.period is not None:
+                domain += self.peak_phase.eq(self.step % self.period)
+        with m.Else():
+            domain += self.since_peak.eq(saturating(self.since_peak))
+            with m.If(self.score == self.peak):
+                domain += self.peak_width.eq(saturating(self.peak_width))
+
+            if self.period is not None:
+                # peak_offset goes up with since_peak, and down every other time peak_width goes up
+                later = self.since_peak != self.length
+                earlier = (self.score == self.peak) & (self.peak_width != self.length) & ~self.peak_width[0]
+                with m.If(later & ~earlier):
+                    domain += self.peak_phase.eq(wrapping_add(self.peak_phase, self.step % self.period, self.period))
+                with m.Elif(earlier & ~later):
+                    domain += self.peak_phase.eq(wrapping_add(self.peak_phase, -(self.step % self.period), self.period))
+
+        return m
+
+    def model(self, bits, threshold=None):
+        """(match, score) on each clock, with score latency clocks behind model_score()
+           and zero until the popcount pipeline fills"""
+        threshold = self.threshold.reset if threshold is None else threshold
+        score = np.zeros(len(bits), np.int32)
+        score[self.latency:] = model_score(self.pattern, self.interval, bits)[:max(len(bits) - self.latency, 0)]
+        return score >= threshold, score
+
+    def model_peak_offset(self, score, start, end, threshold=None):
+        """peak_offset on clock `end` for a run of matches over clocks start..end - 1"""
+        peak = since_peak = peak_width = 0
+        saturating = lambda counter: min(counter + 1, self.length)
+        for value in score[start:end]:
+            if value > peak:
+                peak, since_peak, peak_width = value, 1, 0
+            else:
+                since_peak = saturating(since_peak)
+                if value == peak:
+                    peak_width = saturating(peak_width)
+        return since_peak - ((peak_width + 1) >> 1)
+
+class MatcherBank(Elaboratable):
+    """
+    Several Matchers (with the same interval) sharing one shift register, as long as the
+    longest pattern needs. Every pattern is lined up to end on the newest bit, so bit k of
+    `matches` is exactly what a Matcher for patterns[k] would give; `match` is whether any
+    of them matched and `index` which one (the lowest, if several did).
+    """
+    def __init__(self, patterns, interval, domain="sync"):
+        self.patterns = patterns
+        self.interval = interval
+        self.domain = domain
+        self.taps = [tap_positions(len(pattern), interval) for pattern in patterns]
+        self.lengths = [taps[-1] + 1 for taps in self.taps]
+
+        self.input = Signal()
+        self.shiftreg = Signal(max(self.lengths))
+        self.matches = Signal(len(patterns))
+        self.match = Signal()
+        self.index = Signal(range(max(len(patterns), 2)))
+
+    def inputs(self):
+        return [self.input]
+
+    def outputs(self):
+        return [self.match, self.index]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        domain = getattr(m.d, self.domain)
+        domain += self.shiftreg.eq(Cat(self.shiftreg[1:], self.input))
+
+        for k, (pattern, taps, length) in enumerate(zip(self.patterns, self.taps, self.lengths)):
+            start = len(self.shiftreg) - length
+            m.d.comb += self.matches[k].eq(Cat([bit == self.shiftreg[start + tap] for bit, tap in zip(pattern, taps)]).all())
+
+        m.d.comb += self.match.eq(self.matches.any())
+        for k in reversed(range(len(self.patterns))):
+            with m.If(self.matches[k]):
+                m.d.comb += self.index.eq(k)
+
+        return m
+
+    def model(self, bits):
+        """matches on each clock as a (clocks, patterns) boolean array"""
+        return np.stack([model_match(pattern, self.interval, bits) for pattern in self.patterns], axis=1)
+
+class WordMatcher(Elaboratable):
+    """
+    A Matcher that takes `width` bits a clock (oldest in bit 0, as received from a SERDES)
+    instead of one. Every alignment of the pattern ending in the latest word is checked at
+    once, so bit j of `matches` is what a Matcher's match would be after being fed bit j,
+    `match` is whether any of them did and `offset` is the earliest bit that matched.
+    """
+    def __init__(self, pattern, interval, width=20, domain="sync"):
+        self.pattern = pattern
+        self.interval = interval
+        self.width = width
+        self.domain = domain
+        self.length = (len(pattern) - 1)*(interval + 1) + 1
+
+        self.input = Signal(width)
+        # The latest word and enough of the ones before it for a full pattern to end at any bit
+        self.shiftreg = Signal(self.length - 1 + width)
+        self.matches = Signal(width)
+        self.match = Signal()
+        self.offset = Signal(range(width))
+
+    def inputs(self):
+        return [self.input]
+
+    def outputs(self):
+        return [self.match, self.offset]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        domain = getattr(m.d, self.domain)
+        domain += self.shiftreg.eq(Cat(self.shiftreg[self.width:], self.input))
+
+        for j in range(self.width):
+            window = self.shiftreg[j:j + self.length]
+            m.d.comb += self.matches[j].eq(Cat([self.pattern[i] == window[i*(self.interval + 1)] for i in range(len(self.pattern))]).all())
+
+        m.d.comb += self.match.eq(self.matches.any())
+        for j in reversed(range(self.width)):
+            with m.If(self.matches[j]):
+                m.d.comb += self.offset.eq(j)
 
         return m
 
 class CorrelativeSynchronizer(Elaboratable):
-    def __init__(self, pattern, samples_per_symbol, domain="sync"):
+    """
+    Finds `pattern` in a signal oversampled by samples_per_symbol and then strobes
+    sample_strobe in the middle of every symbol after it. With a threshold, the pattern is
+    found by a CorrelatingMatcher (so up to len(pattern) - threshold bit errors are
+    tolerated, and matcher.threshold can be changed at runtime) and the symbol center is
+    taken from its peak score rather than the middle of the run of matches.
+
+    pattern can also be a list of patterns (i.e. the access addresses of several
+    connections) which are looked for at once by a MatcherBank, and pattern_index is then
+    which one was found.
+
+    With tracking, the sampling point follows clock drift between the transmitter and
+    us: once it's sampling, every transition in the input is an early or late vote
+    depending on whether it came before or after half a symbol from the strobes, and
+    whenever the votes add up to +/-tracking the counter is held back or skipped ahead a
+    sample (so the loop gain is 1/tracking samples per vote). Edges come every
+    samples_per_symbol*2 samples on average, so tracking needs to be small enough that
+    this catches up with the worst drift expected over that long.
+
+    samples_per_symbol doesn't have to be whole (i.e. Fraction(5, 2)), so the sample rate
+    doesn't have to be a multiple of the symbol rate. The matcher's taps are then each
+    rounded to the nearest sample, and the counter becomes a phase accumulator in
+    1/denominator samples that strobes whenever it wraps, so the strobes are (2, 3, 2,
+    3, ...) samples apart and average out to the symbol rate.
+    """
+    def __init__(self, pattern, samples_per_symbol, domain="sync", threshold=None, tracking=None):
+        rate = Fraction(samples_per_symbol)
+        self.fractional = rate.denominator != 1
+        if self.fractional:
+            if rate < 2:
+                raise ValueError("A fractional samples_per_symbol has to be at least 2, got {}".format(rate))
+            if tracking is not None:
+                raise ValueError("Timing tracking needs a whole samples_per_symbol, got {}".format(rate))
+            samples_per_symbol = rate
+        else:
+            samples_per_symbol = int(rate)
+        if tracking is not None and samples_per_symbol < 4:
+            raise ValueError("Timing tracking needs at least 4 samples per symbol, got {}".format(samples_per_symbol))
         self.samples_per_symbol = samples_per_symbol
-        self.matcher = Matcher(pattern, samples_per_symbol - 1, domain=domain)
+        self.threshold = threshold
+        self.tracking = tracking
+        self.multiple = len(pattern) > 0 and hasattr(pattern[0], '__len__')
+        if self.multiple:
+            if threshold is not None:
+                raise ValueError("A threshold can't be used with more than one pattern")
+            self.matcher = MatcherBank(pattern, samples_per_symbol - 1, domain=domain)
+            self.pattern_index = Signal.like(self.matcher.index)
+        elif threshold is None:
+            self.matcher = Matcher(pattern, samples_per_symbol - 1, domain=domain)
+        else:
+            # The counter's phase (in 1/denominator samples when fractional) is loaded from peak_phase
+            rate = Fraction(samples_per_symbol)
+            self.matcher = CorrelatingMatcher(pattern, samples_per_symbol - 1, threshold=threshold,
+                period=rate.numerator, step=rate.denominator, domain=domain)
         self.domain = domain
 
         self.reset = Signal()
         self.input = Signal()
         self.sample_strobe = Signal()
 
+        # Where on the counter transitions land when the strobes are centered, and the
+        # counter values on which a transition is late or early compared to that
+        if tracking is not None:
+            self.edge_count = ((3*samples_per_symbol + 1)//2 - 2) % samples_per_symbol
+            self.late_counts = [(self.edge_count + k) % samples_per_symbol for k in range(1, samples_per_symbol//2 + 1)]
+            self.early_counts = [(self.edge_count - k) % samples_per_symbol for k in range(1, (samples_per_symbol + 1)//2)]
+
+        # Only samples on clocks with enable high are looked at (and counted)
+        self.enable = Signal(reset=1)
+        self.output_valid = Signal()
+
     def inputs(self):
         return [self.input]
 
@@ -50,42 +415,214 @@ class CorrelativeSynchronizer(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
-        eye_width = Signal(range(self.samples_per_symbol + 1))
+        strobe = Signal()
+        eye_width = Signal(range(ceil(self.samples_per_symbol) + 1))
         domain = getattr(m.d, self.domain)
-        counter = Signal(range(self.samples_per_symbol + 1))
+        if self.fractional:
+            # Counts in 1/denominator samples, so a symbol is numerator of them
+            step, period = self.samples_per_symbol.denominator, self.samples_per_symbol.numerator
+            counter = Signal(range(period))
+        else:
+            counter = Signal(range(self.samples_per_symbol + 1))
 
         m.submodules.matcher = self.matcher
         m.d.comb += self.matcher.input.eq(self.input)
 
+        advance = Signal()
+        hold = Signal()
+        if self.fractional and self.threshold is None:
+            # ((eye_width >> 1) + 1)*step % period, kept up to date as eye_width counts
+            eye_phase = Signal(range(period))
+            eye_phase_reset = step % period
+
+        if self.tracking is not None:
+            last = Signal()
+            edge = Signal()
+            votes = Signal(range(-self.tracking, self.tracking + 1))
+            domain += last.eq(self.input)
+            m.d.comb += edge.eq(self.input != last)
+
         with m.FSM(domain=self.domain):
             with m.State('SEARCHING'):
                 with m.If(self.matcher.match):
                     domain += eye_width.eq(0)
+                    if self.fractional and self.threshold is None:
+                        domain += eye_phase.eq(eye_phase_reset)
+                    if self.multiple:
+                        domain += self.pattern_index.eq(self.matcher.index)
                     m.next = "MEASURING"
             with m.State('MEASURING'):
                 with m.If(self.matcher.match):
                     # TODO: Handle eye width that's wider than a symbol
                     domain += eye_width.eq(eye_width + 1)
+                    if self.fractional and self.threshold is None:
+                        # eye_width >> 1 goes up when eye_width is odd, or back to 0 as it wraps
+                        with m.If(eye_width == 2**len(eye_width) - 1):
+                            domain += eye_phase.eq(eye_phase_reset)
+                        with m.Elif(eye_width[0]):
+                            domain += eye_phase.eq(wrapping_add(eye_phase, eye_phase_reset, period))
                 with m.Else():
-                    # The +1 comes from the fact that it takes a clock
-                    # cycle for us to find the match
-                    domain += counter.eq((eye_width >> 1) + 1)
+                    if self.threshold is not None:
+                        # The score is latency clocks behind, which the counter makes up for
+                        rate = Fraction(self.samples_per_symbol)
+                        domain += counter.eq(wrapping_add(self.matcher.peak_phase,
+                            (self.matcher.latency*rate.denominator) % rate.numerator, rate.numerator))
+                    elif self.fractional:
+                        domain += counter.eq(eye_phase)
+                    else:
+                        # The +1 comes from the fact that it takes a clock
+                        # cycle for us to find the match
+                        domain += counter.eq((eye_width >> 1) + 1)
+                    if self.tracking is not None:
+                        domain += votes.eq(0)
                     m.next = "SAMPLING"
             with m.State('SAMPLING'):
+                if self.tracking is not None:
+                    late = Cat([counter == count for count in self.late_counts]).any()
+                    early = Cat([counter == count for count in self.early_counts]).any()
+                    with m.If(edge & late):
+                        with m.If(votes == self.tracking - 1):
+                            m.d.comb += hold.eq(1)
+                            domain += votes.eq(0)
+                        with m.Else():
+                            domain += votes.eq(votes + 1)
+                    with m.Elif(edge & early):
+                        with m.If(votes == 1 - self.tracking):
+                            m.d.comb += advance.eq(1)
+                            domain += votes.eq(0)
+                        with m.Else():
+                            domain += votes.eq(votes - 1)
+
                 with m.If(self.reset):
                     m.next = "SEARCHING"
+                with m.Elif(hold):
+                    domain += strobe.eq(0)
                 with m.Else():
-                    with m.If(counter == self.samples_per_symbol - 1):
-                        domain += [
-                            counter.eq(0),
-                            self.sample_strobe.eq(1)
-                        ]
-                    with m.Else():
-                        domain += [
-                            counter.eq(counter + 1),
-                            self.sample_strobe.eq(0)
-                        ]
-        return m
+                    if self.fractional:
+                        with m.If(counter >= period - step):
+                            domain += [
+                                counter.eq(counter + step - period),
+                                strobe.eq(1)
+                            ]
+                        with m.Else():
+                            domain += [
+                                counter.eq(counter + step),
+                                strobe.eq(0)
+                            ]
+                    else:
+                        with m.If(counter == self.samples_per_symbol - 1):
+                            domain += [
+                                counter.eq(advance),
+                                strobe.eq(1)
+                            ]
+                        with m.Elif(advance & (counter == self.samples_per_symbol - 2)):
+                            domain += [
+                                counter.eq(0),
+                                strobe.eq(1)
+                            ]
+                        with m.Else():
+                            domain += [
+                                counter.eq(counter + 1 + advance),
+                                strobe.eq(0)
+                            ]
+
+        # The strobe register holds still while enable is low, so only pass it on for the
+        # clock after the enabled one that set it
+        outer = clock_enabled(m, self.domain, self.enable, self.output_valid, self.enable)
+        outer.d.comb += self.sample_strobe.eq(strobe & self.output_valid)
+        return outer
+
+    def model(self, samples):
+        """sample_strobe on each clock (with enable high and reset low) as make_callable
+           returns it. Only the search for the first run of matches needs the matcher, after
+           that the strobes are periodic, so this just locates that run and lays them out."""
+        if self.multiple:
+            match = self.matcher.model(samples).any(axis=1)
+        elif self.threshold is None:
+            match = self.matcher.model(samples)
+        else:
+            match, score = self.matcher.model(samples)
+        strobes = np.zeros(len(match), dtype=bool)
+
+        # SEARCHING sees the first match on clock found, MEASURING the end of the run on clock end
+        found = np.flatnonzero(match)
+        if len(found) == 0:
+            return strobes
+        found = found[0]
+        ended = np.flatnonzero(~match[found + 1:])
+        if len(ended) == 0:
+            return strobes
+        end = found + 1 + ended[0]
+
+        # Counters wrap at their width like the registers do
+        wrap = lambda value: value % (1 << Shape.cast(range(ceil(self.samples_per_symbol) + 1)).width)
+        if self.threshold is None:
+            eye_width = wrap(end - found - 1)
+            start = (eye_width >> 1) + 1
+        else:
+            start = self.matcher.model_peak_offset(score, found, end) + self.matcher.latency
+
+        if self.fractional:
+            # The phase accumulator strobes on the clocks where it passes a multiple of a symbol
+            step, period = self.samples_per_symbol.denominator, self.samples_per_symbol.numerator
+            phase = (start*step) % period + step*np.arange(len(strobes) - end - 2)
+            strobes[np.flatnonzero((phase + step)//period > phase//period) + end + 2] = True
+            return strobes
+        counter = wrap(start) if self.threshold is None else start % self.samples_per_symbol
+
+        # SAMPLING starts on clock end + 1, and strobe shows up the clock after the counter
+        # hits samples_per_symbol - 1
+        if self.tracking is None:
+            first = end + 1 + wrap(self.samples_per_symbol - 1 - counter) + 1
+            strobes[first::self.samples_per_symbol] = True
+            return strobes
+
+        # Otherwise the counter only runs freely from one nudge to the next, and in between
+        # it reads (t - phase) % sps on clock t for some phase. So tally up the votes the
+        # transitions would cast for every phase at once, and then just jump from nudge to
+        # nudge, each one being where the running tally for the current phase gets to
+        # +/-tracking votes past the previous one.
+        sps = self.samples_per_symbol
+        bits = np.asarray(samples) > 0
+        transitions = np.flatnonzero(bits[end + 1:] != bits[end:-1]) + end + 1
+        vote = np.zeros(sps, np.int8)
+        vote[self.early_counts] = -1
+        vote[self.late_counts] = 1
+        tally = np.cumsum(vote[(transitions - np.arange(sps)[:, None]) % sps], axis=1, dtype=np.int32)
+
+        start = end + 1
+        while True:
+            # The counter gets to sps - 1 on clock first, having started at counter on
+            # clock start (which can be more than a symbol before when it starts above
+            # sps - 1, in which case it can't vote until it wraps)
+            first = start + wrap(sps - 1 - counter)
+            phase = (first + 1) % sps
+            i = np.searchsorted(transitions, max(start, first + 1 - sps))
+            base = tally[phase, i - 1] if i else 0
+
+            # Search in growing windows so each nudge only costs about the distance to it
+            width, nudge = 64, None
+            while i < len(transitions):
+                found = np.flatnonzero(np.abs(tally[phase, i:i + width] - base) >= self.tracking)
+                if len(found):
+                    nudge = i + found[0]
+                    break
+                i, width = i + width, 2*width
+            if nudge is None:
+                break
+
+            # Lay out the strobes up to the nudge, then restart from after it
+            t = transitions[nudge]
+            at = (t - phase) % sps
+            late = tally[phase, nudge] > base
+            strobes[first + 1:t + 1:sps] = True
+            if not late and at >= sps - 2 and t + 1 < len(strobes):
+                strobes[t + 1] = True
+            counter = at if late else (at + 2) % sps if at >= sps - 2 else at + 2
+            start = t + 1
+
+        strobes[first + 1::sps] = True
+        return strobes
 
 def test_pattern_matching():
     m = Matcher(pattern=[0,1,1,0], interval=1)
@@ -105,4 +642,281 @@ def test_pattern_matching():
     sim.add_sync_process(process)
     
     with sim.write_vcd("matching.vcd"):
-        sim.run()
\ No newline at end of file
+        sim.run()
+
+def test_synchronizer_enable():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(0)
+    pattern = [1, 0, 1, 1, 0, 0, 1, 0]
+    bits = [0]*3 + pattern + list(rng.integers(0, 2, 20))
+    samples = np.repeat(bits, 4)
+
+    def strobes(enables):
+        sync = CorrelativeSynchronizer(pattern, 4)
+        sync_callable = make_callable(sync, inputs=[sync.input, sync.enable], outputs=[sync.sample_strobe])
+        found, i = [], 0
+        for enable in enables:
+            if i == len(samples):
+                break
+            if sync_callable(int(samples[i]), int(enable)):
+                found.append(i)
+            i += int(enable)
+        return found
+
+    # Strobes land on the same samples with or without stalls in between
+    steady = strobes(np.ones(len(samples), dtype=bool))
+    assert len(steady) > 10
+    assert strobes(rng.integers(0, 3, 4*len(samples)) > 0)[:len(steady) - 1] == steady[:-1]
+
+def test_word_matcher():
+    from alldigitalradio.io.numpy import make_callable
+    from alldigitalradio.util import pack_mem
+
+    rng = np.random.default_rng(1)
+    for pattern, interval, width in [([0, 1, 1, 0], 1, 20), ([1, 0, 1, 1, 0, 0, 1, 0], 3, 20), ([1, 1, 0], 0, 4), ([1, 0, 0, 1, 1], 5, 8)]:
+        bits = rng.integers(0, 2, 60*width)
+        # Plant copies of the pattern at a few offsets so there are matches to find
+        for start in rng.integers(0, len(bits) - 64, 12):
+            bits[start:start + len(pattern)*(interval + 1):interval + 1] = pattern
+
+        # Both return what they saw up to the clock before, so skip the first (reset) outputs
+        serial = make_callable(Matcher(pattern, interval))
+        serial_matches = np.array([serial(int(b))[0] for b in np.append(bits, 0)])[1:]
+
+        matcher = WordMatcher(pattern, interval, width=width)
+        parallel = make_callable(matcher, outputs=[matcher.match, matcher.offset, matcher.matches])
+        for k, word in enumerate(pack_mem(bits, width)):
+            match, offset, matches = parallel(int(word))
+            expected = serial_matches[(k - 1)*width:k*width] if k else np.zeros(width, int)
+            assert [(matches >> j) & 1 for j in range(width)] == list(expected)
+            assert match == expected.any()
+            if match:
+                assert offset == np.argmax(expected)
+        assert serial_matches.sum() >= 12
+
+def test_correlating_matcher():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(2)
+    pattern = [int(b) for b in rng.integers(0, 2, 32)]
+    interval = 1
+    matcher = CorrelatingMatcher(pattern, interval, threshold=30)
+    taps = np.arange(len(pattern))*(interval + 1)
+
+    bits = rng.integers(0, 2, 600)
+    for start, errors in [(100, 0), (250, 2), (400, 3)]:
+        bits[start + taps] = pattern
+        bits[start + taps[rng.choice(len(pattern), errors, replace=False)]] ^= 1
+
+    # The score of the window ending at each bit, as a Matcher would see it a clock later
+    windows = np.lib.stride_tricks.sliding_window_view(np.concatenate([np.zeros(matcher.length - 1, int), bits]), matcher.length)
+    scores = (windows[:, taps] == pattern).sum(axis=1)
+
+    exact = make_callable(Matcher(pattern, interval))
+    matcher_callable = make_callable(matcher)
+    delay = matcher.latency + 1
+    outputs = [matcher_callable(int(b), 30 if i < 500 else 32) for i, b in enumerate(np.append(bits, [0]*delay))]
+    assert [score for _, score, _ in outputs[delay:]] == list(scores)
+    assert [match for match, _, _ in outputs[delay:]] == list(scores >= np.where(np.arange(len(bits)) < 500 - delay, 30, 32))
+
+    # A bit error or two is enough to miss with an exact match but not with a threshold
+    assert sum(exact(int(b))[0] for b in bits) == 1
+    assert [i - delay for i, (match, _, _) in enumerate(outputs) if match] == [100 + taps[-1], 250 + taps[-1]]
+
+    # peak_phase follows peak_offset without a divider
+    for period, step in [(5, 2), (4, 1)]:
+        phased = CorrelatingMatcher(pattern, interval, threshold=28, period=period, step=step)
+        phased_callable = make_callable(phased, outputs=[phased.peak_offset, phased.peak_phase])
+        outputs = [phased_callable(int(b)) for b in bits]
+        assert all(phase == offset*step % period for offset, phase in outputs)
+        assert len(set(offset for offset, _ in outputs)) > period
+
+def test_correlating_synchronizer():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(3)
+    samples_per_symbol = 8
+    pattern = [int(b) for b in rng.integers(0, 2, 16)]
+    bits = list(rng.integers(0, 2, 10)) + pattern + list(rng.integers(0, 2, 20))
+    samples = np.repeat(bits, samples_per_symbol)
+
+    def strobes(samples, threshold):
+        sync = CorrelativeSynchronizer(pattern, samples_per_symbol, threshold=threshold)
+        sync_callable = make_callable(sync)
+        return [i for i, s in enumerate(samples) if sync_callable(int(s))]
+
+    # On a clean signal the peak is the middle of the eye, exactly as with exact matching
+    exact = strobes(samples, None)
+    assert len(exact) > 10
+    assert strobes(samples, len(pattern)) == exact
+
+    # With noisy edges and a bit error in the pattern, exact matching never finds it but
+    # the correlator still strobes close to the symbol centers
+    noisy = samples.copy()
+    edges = np.nonzero(np.diff(samples))[0] + 1
+    noisy[edges] ^= rng.integers(0, 2, len(edges))
+    noisy[13*samples_per_symbol:14*samples_per_symbol] ^= 1
+    assert strobes(noisy, None) == []
+    found = strobes(noisy, len(pattern) - 1)
+    assert len(found) > 10
+    assert all((strobe - exact[0]) % samples_per_symbol in (0, 1, samples_per_symbol - 1) for strobe in found)
+
+def test_matcher_models():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(4)
+    samples_per_symbol = 6
+    pattern = [int(b) for b in rng.integers(0, 2, 12)]
+    bits = np.concatenate([rng.integers(0, 2, 15), pattern, rng.integers(0, 2, 25)])
+    clean = np.repeat(bits, samples_per_symbol)
+    noisy = clean ^ (rng.random(len(clean)) < 0.03)
+
+    for samples in [clean, noisy, PackedBits.from_bits(noisy), rng.integers(0, 2, 300)]:
+        for interval in [0, samples_per_symbol - 1]:
+            matcher = Matcher(pattern, interval)
+            matcher_callable = make_callable(matcher)
+            assert [matcher_callable(int(b))[0] for b in np.asarray(samples)] == list(matcher.model(samples))
+
+            correlator = CorrelatingMatcher(pattern, interval, threshold=10)
+            correlator_callable = make_callable(correlator)
+            match, score = correlator.model(samples)
+            assert [correlator_callable(int(b), 10)[:2] for b in np.asarray(samples)] == [list(x) for x in zip(match, score)]
+
+        for threshold in [None, len(pattern), len(pattern) - 2]:
+            sync = CorrelativeSynchronizer(pattern, samples_per_symbol, threshold=threshold)
+            sync_callable = make_callable(sync)
+            assert [sync_callable(int(b)) for b in np.asarray(samples)] == list(sync.model(samples))
+
+def test_matcher_bank():
+    from alldigitalradio.io.numpy import make_callable
+    from alldigitalradio.resources import resource_usage
+
+    rng = np.random.default_rng(5)
+    patterns = [[1, 0, 1, 1, 0, 1], [0, 0, 1, 1], [1, 1, 1, 0, 0, 0, 1, 0, 1]]
+    interval = 2
+    bits = rng.integers(0, 2, 400)
+    for k, start in enumerate([50, 150, 250, 300]):
+        pattern = patterns[k % len(patterns)]
+        bits[start:start + len(pattern)*(interval + 1):interval + 1] = pattern
+
+    bank = MatcherBank(patterns, interval)
+    bank_callable = make_callable(bank, outputs=[bank.match, bank.index, bank.matches])
+    matcher_callables = [make_callable(Matcher(pattern, interval)) for pattern in patterns]
+    expected = bank.model(bits)
+    for i, b in enumerate(bits):
+        match, index, matches = bank_callable(int(b))
+        separate = [f(int(b))[0] for f in matcher_callables]
+        assert [(matches >> k) & 1 for k in range(len(patterns))] == separate == list(expected[i])
+        assert match == any(separate)
+        if match:
+            assert index == separate.index(1)
+    assert expected.any(axis=0).all()
+
+    assert resource_usage(bank)['registers'] < sum(resource_usage(Matcher(p, interval))['registers'] for p in patterns)
+
+    # A synchronizer looking for all of them locks onto whichever shows up, like one that
+    # was only looking for that one
+    samples = np.repeat(np.concatenate([rng.integers(0, 2, 10), patterns[1], rng.integers(0, 2, 20)]), 3)
+    sync = CorrelativeSynchronizer(patterns, 3)
+    sync_callable = make_callable(sync, outputs=[sync.sample_strobe, sync.pattern_index])
+    single = CorrelativeSynchronizer(patterns[1], 3)
+    outputs = [sync_callable(int(b)) for b in samples]
+    assert [strobe for strobe, _ in outputs] == list(sync.model(samples)) == list(single.model(samples))
+    assert outputs[-1][1] == 1 and any(strobe for strobe, _ in outputs)
+
+def test_memory_matcher():
+    from alldigitalradio.io.numpy import make_callable
+    from alldigitalradio.resources import resource_usage
+
+    rng = np.random.default_rng(6)
+    pattern = [int(b) for b in rng.integers(0, 2, 8)]
+    for interval in [2, 3, 9]:
+        bits = rng.integers(0, 2, 600)
+        for start in [40, 300]:
+            bits[start:start + len(pattern)*(interval + 1):interval + 1] = pattern
+
+        matcher = MemoryMatcher(pattern, interval)
+        matcher_callable = make_callable(matcher)
+        reference = make_callable(Matcher(pattern, interval))
+        outputs = [matcher_callable(int(b)) for b in bits]
+        assert outputs == [reference(int(b)) for b in bits]
+        assert [match for match, _ in outputs] == list(matcher.model(bits))
+        assert sum(match for match, _ in outputs) >= 2
+
+    # i.e. a 32 bit access address at 40 samples per symbol
+    registers = resource_usage(MemoryMatcher([1, 0]*16, 39))['registers']
+    assert registers*10 < resource_usage(Matcher([1, 0]*16, 39))['registers']
+
+def test_timing_tracking():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(7)
+    pattern = [int(b) for b in rng.integers(0, 2, 32)]
+
+    def transmit(samples_per_symbol, ppm, symbols):
+        bits = np.concatenate([rng.integers(0, 2, 10), pattern, rng.integers(0, 2, symbols)])
+        period = samples_per_symbol*(1 + ppm*1e-6)
+        symbol = (np.arange(int((len(bits) - 1)*period))/period + 0.3).astype(int)
+        return bits[symbol], symbol
+
+    # The model keeps up with the hardware even with drift far beyond a crystal's and
+    # noisy edges
+    for samples_per_symbol, ppm, threshold in [(5, -20000, None), (8, 15000, 30)]:
+        samples, _ = transmit(samples_per_symbol, ppm, 100)
+        edges = np.nonzero(np.diff(samples))[0] + 1
+        samples[edges] ^= rng.integers(0, 2, len(edges))
+        for tracking in [1, 3]:
+            sync = CorrelativeSynchronizer(pattern, samples_per_symbol, threshold=threshold, tracking=tracking)
+            sync_callable = make_callable(sync)
+            assert [sync_callable(int(b)) for b in samples] == list(sync.model(samples))
+
+    # With +/-50 ppm a free running counter slips a symbol before the end of a long
+    # packet, but a tracking one samples every symbol once (2 samples back from the strobe)
+    for ppm in [-50, 50]:
+        samples, symbol = transmit(4, ppm, 20000)
+        for tracking in [None, 1, 8]:
+            sampled = np.flatnonzero(CorrelativeSynchronizer(pattern, 4, tracking=tracking).model(samples)) - 2
+            assert len(sampled) > 19900
+            assert (np.diff(symbol[sampled]) == 1).all() == (tracking is not None)
+
+def test_fractional_rate():
+    from alldigitalradio.io.numpy import make_callable
+
+    rng = np.random.default_rng(8)
+    pattern = [int(b) for b in rng.integers(0, 2, 16)]
+    bits = np.concatenate([rng.integers(0, 2, 10), pattern, rng.integers(0, 2, 60)])
+
+    for samples_per_symbol in [Fraction(5, 2), Fraction(10, 3)]:
+        for phase, threshold in [(0.1, None), (0.8, None), (0.5, 15)]:
+            symbol = (np.arange(int((len(bits) - 1)*samples_per_symbol))/float(samples_per_symbol) + phase).astype(int)
+            samples = bits[symbol]
+            sync = CorrelativeSynchronizer(pattern, samples_per_symbol, threshold=threshold)
+            sync_callable = make_callable(sync)
+            strobes = [sync_callable(int(b)) for b in samples]
+            assert strobes == list(sync.model(samples))
+
+            # Every symbol after the pattern is sampled once (2 samples back from the strobe)
+            sampled = np.flatnonzero(strobes) - 2
+            assert len(sampled) > 55
+            assert (np.diff(symbol[sampled]) == 1).all()
+
+    # A whole Fraction is the same as an int
+    samples = np.repeat(bits, 4)
+    assert list(CorrelativeSynchronizer(pattern, Fraction(4)).model(samples)) == list(CorrelativeSynchronizer(pattern, 4).model(samples))
+
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.default_rng(0)
+    pattern = [int(b) for b in rng.integers(0, 2, 32)]
+    bits = np.concatenate([rng.integers(0, 2, 1000), pattern, rng.integers(0, 2, 5*1000*1000)])
+    samples = PackedBits.from_bits(np.repeat(bits, 4))
+
+    for name, block in [("Matcher", Matcher(pattern, 3)),
+            ("CorrelativeSynchronizer", CorrelativeSynchronizer(pattern, 4)),
+            ("correlating", CorrelativeSynchronizer(pattern, 4, threshold=30)),
+            ("tracking", CorrelativeSynchronizer(pattern, 4, tracking=4))]:
+        start = time.time()
+        block.model(samples)
+        print("{:>24}: {:12.0f} samples/s".format(name, len(samples)/(time.time() - start)))
@@ -2,6 +2,8 @@
 from nmigen import *
 import numpy as np
 
+from alldigitalradio.util import clock_enabled
+
 class MagnitudeApproximator(Elaboratable):
     def __init__(self, simple=False):
         self.simple = simple
@@ -11,6 +13,10 @@ class MagnitudeApproximator(Elaboratable):
 
         self.magnitude = Signal(unsigned(32))
 
+        # This is combinational, so a valid input is a valid output
+        self.enable = Signal(reset=1)
+        self.output_valid = Signal()
+
     def inputs(self):
         return [self.inputI, self.inputQ]
 
@@ -20,6 +26,8 @@ class MagnitudeApproximator(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
+        m.d.comb += self.output_valid.eq(self.enable)
+
         if self.simple:
             m.d.comb += self.magnitude.eq(abs(self.inputI) + abs(self.inputQ))
         else:
@@ -51,6 +59,10 @@ class Cordic(Elaboratable):
     number of stages + 2.
     
     Note: there is no constant factor correction in this implementation
+
+    The whole pipeline only advances on clocks with enable high (i.e. driven by a
+    decimator's output_valid), so latency is then counted in enabled clocks, and
+    output_valid is high after each one.
     """
     def __init__(self, bit_depth=16, stages=8, domain: str="sync"):
         self.bit_depth = bit_depth
@@ -68,6 +80,15 @@ class Cordic(Elaboratable):
         self.output_y = Signal(signed(bit_depth))
 
         self.latency = stages + 2
+
+        self.enable = Signal(reset=1)
+        self.output_valid = Signal()
+
+    def inputs(self):
+        return [self.input_x, self.input_y]
+
+    def outputs(self):
+        return [self.magnitude, self.angle]
         
     def elaborate(self, platform):
         m = Module()
@@ -142,5 +163,44 @@ class Cordic(Elaboratable):
             self.output_x.eq(cur_x),
             self.output_y.eq(cur_y),
         ]
-        
-        return m
\ No newline at end of file
+
+        return clock_enabled(m, self.domain, self.enable, self.output_valid, self.enable)
+
+def test_clock_enabled_chain():
+    from alldigitalradio.filter import SimpleDecimator
+    from alldigitalradio.io.numpy import make_callable
+
+    class Chain(Elaboratable):
+        """I/Q samples decimated and then converted to polar, only on decimated samples"""
+        def __init__(self):
+            self.decimatorI = SimpleDecimator(5, max_val=100)
+            self.decimatorQ = SimpleDecimator(5, max_val=100)
+            self.cordic = Cordic(bit_depth=16)
+
+        def elaborate(self, platform):
+            m = Module()
+            m.submodules.decimatorI = self.decimatorI
+            m.submodules.decimatorQ = self.decimatorQ
+            m.submodules.cordic = self.cordic
+            m.d.comb += [
+                self.cordic.input_x.eq(self.decimatorI.output),
+                self.cordic.input_y.eq(self.decimatorQ.output),
+                self.cordic.enable.eq(self.decimatorI.output_valid),
+            ]
+            return m
+
+    rng = np.random.default_rng(8)
+    samples = rng.integers(-100, 101, (2, 5*40))
+
+    chain = Chain()
+    chain_callable = make_callable(chain, inputs=[chain.decimatorI.input, chain.decimatorQ.input],
+        outputs=[chain.cordic.magnitude, chain.cordic.angle, chain.cordic.output_valid])
+    chained = [out[:2] for out in (chain_callable(int(i), int(q)) for i, q in samples.T) if out[2]]
+
+    # The same as running a free running Cordic on just the decimated samples
+    cordic = Cordic(bit_depth=16)
+    cordic_callable = make_callable(cordic)
+    decimated = samples.reshape(2, -1, 5).sum(axis=2)
+    direct = [cordic_callable(int(x), int(y)) for x, y in decimated.T]
+    assert len(chained) > 30
+    assert chained[cordic.latency:] == direct[cordic.latency + 1:len(chained) + 1]
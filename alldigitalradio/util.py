@@ -1,17 +1,219 @@
+from fractions import Fraction
+
 import numpy as np
+from nmigen import EnableInserter, Module, Signal
+
+def word_dtype(width: int):
+    """Smallest unsigned numpy type able to hold a word of `width` bits"""
+    if width < 1 or width > 64:
+        raise ValueError("Word width must be between 1 and 64, got {}".format(width))
+    return np.uint32 if width <= 32 else np.uint64
 
 def pack_mem(bits: np.ndarray, width: int):
-    out = []
-    for word in np.reshape(bits, (len(bits)//width, width)):
-        out.append(int(sum([1 << i for i in range(width) if word[i] > 0])))
-    return out
+    """Packs a sequence of samples into `width`-bit words, LSB first. Any sample > 0
+       is treated as a 1, so both 0/1 and binarize()'d -1/+1 inputs work."""
+    if isinstance(bits, PackedBits):
+        if bits.width == width and len(bits) % width == 0:
+            return bits.aligned()
+        bits = bits.unpack()
+
+    dtype = word_dtype(width)
+    nbytes = np.dtype(dtype).itemsize
+    bits = np.reshape(np.asarray(bits) > 0, (-1, width))
+
+    packed = np.zeros((bits.shape[0], nbytes), dtype=np.uint8)
+    packed[:, :(width + 7)//8] = np.packbits(bits, axis=1, bitorder='little')
+    return packed.view('<u{}'.format(nbytes)).reshape(-1).astype(dtype, copy=False)
 
 def unpack_mem(words: np.ndarray, width: int):
-    out = []
-    for word in words:
-        for i in range(width):
-            out.append(1 if word & (1 << i) else 0)
-    return np.array(out)
+    """Inverse of pack_mem, returns a flat int8 array of 0/1 samples (signed, so that
+       arithmetic like unpack_mem(...)*2 - 1 gives -1/+1 samples)"""
+    if isinstance(words, PackedBits):
+        return words.unpack()
+
+    dtype = word_dtype(width)
+    nbytes = np.dtype(dtype).itemsize
+    words = np.asarray(words).astype('<u{}'.format(nbytes), copy=False).reshape(-1, 1)
+
+    bits = np.unpackbits(words.view(np.uint8), axis=1, bitorder='little')
+    return bits[:, :width].reshape(-1).view(np.int8)
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(words: np.ndarray):
+    """Number of set bits in each element of an unsigned integer array"""
+    if hasattr(np, 'bitwise_count'):
+        # NumPy 2.0+ has a native (and much faster) popcount
+        return np.bitwise_count(words).astype(np.int32, copy=False)
+
+    words = np.ascontiguousarray(words)
+    octets = words.view(np.uint8).reshape(words.shape + (words.dtype.itemsize,))
+    return _POPCOUNT[octets].sum(axis=-1, dtype=np.int32)
+
+def split_chunks(width, split):
+    """(start, stop) bit ranges splitting a width-bit word into `split` nearly equal chunks"""
+    bounds = [(width*i)//split for i in range(split + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def tree_stages(split, levels_per_stage):
+    """Register stages in a popcount_tree() adding up `split` chunks"""
+    levels = int(np.ceil(np.log2(split)))
+    return int(np.ceil(levels/(levels_per_stage or levels))) if levels else 0
+
+def popcount_tree(m, domain, bits, chunks, levels_per_stage, name):
+    """Registered popcounts of each chunk of bits summed by an adder tree with a register
+       after every levels_per_stage levels (and after the last), see tree_stages()"""
+    nodes = []
+    for i, (start, stop) in enumerate(chunks):
+        node = Signal(range(stop - start + 1), name="{}_chunk{}".format(name, i))
+        domain += node.eq(sum(bits[start:stop]))
+        nodes.append((node, stop - start))
+
+    level = 0
+    while len(nodes) > 1:
+        level += 1
+        registered = len(nodes) <= 2 or (levels_per_stage and level % levels_per_stage == 0)
+        summed = []
+        for i in range(0, len(nodes), 2):
+            pair = nodes[i:i + 2]
+            total = sum(n for _, n in pair)
+            node = Signal(range(total + 1), name="{}_level{}_{}".format(name, level, i//2))
+            if registered:
+                domain += node.eq(sum(s for s, _ in pair))
+            else:
+                m.d.comb += node.eq(sum(s for s, _ in pair))
+            summed.append((node, total))
+        nodes = summed
+
+    return nodes[0][0]
+
+def clock_enabled(m, domain, enable, output_valid, valid):
+    """
+    Wraps the module m so that everything it has in `domain` only updates on clocks when
+    `enable` is high, and registers `valid` (when the output is about to change) into
+    output_valid. Chaining one block's output_valid into the next one's enable makes a
+    pipeline that only does anything on valid samples, which leaves the slower stages
+    after a decimator free to take several clocks (or share logic) per sample.
+    """
+    outer = Module()
+    outer.submodules.pipeline = EnableInserter({domain: enable})(m)
+    outer_domain = getattr(outer.d, domain)
+    outer_domain += output_valid.eq(valid)
+    return outer
+
+class PackedBits(object):
+    """A stream of one-bit samples stored pack_mem()-style in `width`-bit words.
+
+       len() and indexing/slicing are in bits, and slices are O(1) views that just
+       track a starting bit offset into the shared word array. Iterating yields the
+       (re-aligned) words, so a PackedBits can be passed straight in as a Memory init.
+    """
+    def __init__(self, words, width: int=20, offset: int=0, length: int=None):
+        self.width = width
+        self.words = np.asarray(words).astype(word_dtype(width), copy=False).reshape(-1)
+        self.offset = offset
+        self.length = len(self.words)*width - offset if length is None else length
+
+    @classmethod
+    def from_bits(cls, bits, width: int=20):
+        """Packs 0/1 or binarize()'d samples, zero-padding the final word"""
+        bits = np.asarray(bits) > 0
+        padded = np.zeros((len(bits) + width - 1)//width*width, dtype=bool)
+        padded[:len(bits)] = bits
+        return cls(pack_mem(padded, width), width, length=len(bits))
+
+    @classmethod
+    def load(cls, path, width: int=20, mmap: bool=True):
+        """Opens a raw file of little-endian words (as written by save()). By default the
+           file is memory-mapped rather than read, so it can be much larger than RAM."""
+        dtype = '<u{}'.format(np.dtype(word_dtype(width)).itemsize)
+        words = np.memmap(path, dtype=dtype, mode='r') if mmap else np.fromfile(path, dtype=dtype)
+        return cls(words, width)
+
+    def save(self, path):
+        """Writes the aligned words as raw little-endian values, zero-padding the final word"""
+        dtype = '<u{}'.format(np.dtype(word_dtype(self.width)).itemsize)
+        self.aligned().astype(dtype, copy=False).tofile(path)
+
+    def aligned(self):
+        """The words of this stream with the first sample at bit 0 of the first word. Without
+           an offset (or padding to clear) that's a view of the words, otherwise each word
+           is put together from the two it straddles."""
+        count = (self.length + self.width - 1)//self.width
+        first, shift = divmod(self.offset, self.width)
+        words = self.words[first:first + count + 1]
+        word = words.dtype.type
+        if shift:
+            high = np.zeros(count, words.dtype)
+            high[:len(words) - 1] = words[1:count + 1] << word(self.width - shift)
+            words = ((words[:count] >> word(shift)) | high) & word((1 << self.width) - 1)
+        else:
+            words = words[:count]
+
+        if self.length % self.width:
+            if not shift:
+                words = words.copy()
+            words[-1] &= word((1 << (self.length % self.width)) - 1)
+        return words
+
+    def unpack(self):
+        end = self.offset + self.length
+        words = self.words[self.offset//self.width:(end + self.width - 1)//self.width]
+        start = self.offset % self.width
+        return unpack_mem(words, self.width)[start:start + self.length]
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.aligned())
+
+    def __array__(self, dtype=None):
+        return self.unpack() if dtype is None else self.unpack().astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return PackedBits.from_bits(self.unpack()[key], self.width)
+            start = self.offset + start
+            stop = max(self.offset + stop, start)
+            return PackedBits(self.words[start//self.width:(stop + self.width - 1)//self.width],
+                self.width, offset=start % self.width, length=stop - start)
+
+        if key < 0:
+            key += self.length
+        if key < 0 or key >= self.length:
+            raise IndexError("bit index out of range")
+        word, bit = divmod(self.offset + key, self.width)
+        return int(self.words[word] >> bit) & 1
+
+    def __add__(self, other):
+        if not isinstance(other, PackedBits):
+            other = PackedBits.from_bits(other, self.width)
+        if self.width == other.width and self.offset == 0 and self.length % self.width == 0 and other.offset == 0:
+            return PackedBits(np.concatenate([self.aligned(), other.aligned()]), self.width, length=self.length + other.length)
+        return PackedBits.from_bits(np.concatenate([self.unpack(), other.unpack()]), self.width)
+
+    def __repr__(self):
+        return "PackedBits(length={}, width={})".format(self.length, self.width)
+
+def word_chunks(source, chunk_words: int=1 << 20):
+    """Yields arrays of at most `chunk_words` words from a word array, a PackedBits (i.e. a
+       memory-mapped capture from PackedBits.load()) or an iterable of either (such as
+       stream_carrier()), so that models can work through captures larger than memory."""
+    if isinstance(source, (PackedBits, np.ndarray)):
+        source = [source]
+    for chunk in source:
+        if isinstance(chunk, PackedBits):
+            # Slice before aligning so only one chunk's worth of words is ever copied
+            bits = chunk_words*chunk.width
+            for start in range(0, len(chunk), bits):
+                yield chunk[start:start + bits].aligned()
+            continue
+        chunk = np.asarray(chunk)
+        for start in range(0, len(chunk), chunk_words):
+            yield chunk[start:start + chunk_words]
 
 def make_carrier(freq: float=None, sample_rate: float=None, samples: int=None, phase: float=0):
     t = (1/sample_rate)*np.arange(samples)
@@ -21,7 +223,120 @@ def binarize(a: np.ndarray):
     return np.sign(a)
     return (np.sign(a)*0.5 + 0.5).astype(np.uint8)
 
+def make_periodic_carrier(cycles: int=None, samples: int=None, phase: float=0):
+    """binarize(make_carrier(...)) for a carrier that completes exactly `cycles` cycles every
+       `samples` samples. Each sample's phase is reduced with integer arithmetic (with the
+       phase offset rounded to a 2**-20 turn grid), so there is no float drift and samples
+       that land exactly on a zero crossing come out as 0 rather than a +/-1e-16 coin flip."""
+    turns = Fraction(phase/(2*np.pi)).limit_denominator(1 << 20)
+    modulus = samples*turns.denominator
+    n = np.arange(samples, dtype=np.int64)
+    u = ((cycles*n) % samples * turns.denominator - turns.numerator*samples) % modulus
+
+    # cos(2*pi*u/modulus) is positive when u/modulus is within a quarter turn of 0
+    out = np.where((4*u < modulus) | (4*u > 3*modulus), 1, -1).astype(np.int8)
+    out[(4*u == modulus) | (4*u == 3*modulus)] = 0
+    return out
+
+def stream_carrier(freq: float=None, sample_rate: float=None, samples: int=None, phase: float=0, width: int=20, chunk_words: int=4096):
+    """Generates pack_mem(binarize(make_carrier(...)), width) in chunks of at most
+       `chunk_words` words so that memory use doesn't depend on the sample count.
+       Each chunk is computed from absolute sample indices, so the phase is continuous
+       across chunk boundaries and the concatenated output is identical to the one-shot
+       version. If `samples` is None this never ends, otherwise any trailing samples
+       that don't fill a whole word are dropped."""
+    total_words = None if samples is None else samples//width
+    word = 0
+    while total_words is None or word < total_words:
+        count = chunk_words if total_words is None else min(chunk_words, total_words - word)
+        t = (1/sample_rate)*np.arange(word*width, (word + count)*width)
+        yield pack_mem(binarize(np.real(np.exp(1j*(2*np.pi*freq*t - phase)))), width)
+        word += count
+
 GHz = 1e9
 MHz = 1e6
 KHz = 1e3
-Hz = 1
\ No newline at end of file
+Hz = 1
+
+def _reference_pack_mem(bits, width):
+    # The original per-bit implementation, kept to check against and benchmark with
+    out = []
+    for word in np.reshape(bits, (len(bits)//width, width)):
+        out.append(int(sum([1 << i for i in range(width) if word[i] > 0])))
+    return out
+
+def _reference_unpack_mem(words, width):
+    out = []
+    for word in words:
+        for i in range(width):
+            out.append(1 if int(word) & (1 << i) else 0)
+    return np.array(out)
+
+def test_pack_mem():
+    rng = np.random.default_rng(0)
+    for width in [1, 7, 8, 16, 20, 31, 32, 33, 40, 63, 64]:
+        bits = binarize(rng.standard_normal(width*37))
+        packed = pack_mem(bits, width)
+        assert packed.dtype == word_dtype(width)
+        assert list(map(int, packed)) == _reference_pack_mem(bits, width)
+        assert (unpack_mem(packed, width) == _reference_unpack_mem(packed, width)).all()
+        assert (unpack_mem(packed, width) == (bits > 0)).all()
+        assert (unpack_mem(packed, width)*2 - 1 == bits).all()
+
+def test_packed_bits(tmp_path):
+    bits = (np.random.default_rng(1).standard_normal(20*50 + 13) > 0).astype(np.uint8)
+    packed = PackedBits.from_bits(binarize(bits*2.0 - 1), 20)
+    assert len(packed) == len(bits)
+    assert (np.asarray(packed) == bits).all()
+
+    for start, stop in [(0, 40), (3, 77), (19, 20), (20, 1013), (500, 500)]:
+        view = packed[start:stop]
+        assert len(view) == stop - start
+        assert (view.unpack() == bits[start:stop]).all()
+        assert (unpack_mem(pack_mem(view[:len(view)//20*20], 20), 20) == bits[start:start + len(view)//20*20]).all()
+        assert [view[i] for i in range(len(view))] == list(bits[start:stop])
+        assert (view.aligned() == PackedBits.from_bits(bits[start:stop], 20).words).all()
+        assert (np.concatenate(list(word_chunks(view, 3)) + [np.zeros(0, np.uint32)]) == view.aligned()).all()
+
+    assert ((packed[:40] + packed[40:]).unpack() == bits).all()
+    assert ((packed[:7] + packed[7:]).unpack() == bits).all()
+    assert ((packed[7:40] + packed[40:]).unpack() == bits[7:]).all()
+    assert ((packed[20:40] + packed[40:]).unpack() == bits[20:]).all()
+
+    path = str(tmp_path / "capture.bin")
+    packed.save(path)
+    loaded = PackedBits.load(path, 20)
+    assert (loaded[:len(bits)].unpack() == bits).all()
+    assert list(loaded) == list(packed)
+
+def test_stream_carrier():
+    args = dict(freq=2.402*GHz, sample_rate=5*GHz, phase=np.pi/2)
+    ref = pack_mem(binarize(make_carrier(samples=20*1000, **args)), 20)
+
+    chunks = list(stream_carrier(samples=20*1000 + 7, chunk_words=64, **args))
+    assert max(len(c) for c in chunks) == 64
+    assert (np.concatenate(chunks) == ref).all()
+
+    endless = stream_carrier(chunk_words=300, **args)
+    assert (np.concatenate([next(endless) for _ in range(4)])[:1000] == ref).all()
+
+if __name__ == '__main__':
+    import time
+
+    def bench(name, f, *args):
+        start = time.time()
+        f(*args)
+        elapsed = time.time() - start
+        print("{:>24}: {:8.3f}s".format(name, elapsed))
+        return elapsed
+
+    bits = binarize(np.random.default_rng(0).standard_normal(4*1000*1000))
+    for width in [20, 32, 64]:
+        print("{} bits, width {}".format(len(bits), width))
+        words = pack_mem(bits, width)
+        slow = bench("reference pack_mem", _reference_pack_mem, bits, width)
+        fast = bench("pack_mem", pack_mem, bits, width)
+        print("{:>24}: {:8.1f}x".format("speedup", slow/fast))
+        slow = bench("reference unpack_mem", _reference_unpack_mem, words, width)
+        fast = bench("unpack_mem", unpack_mem, words, width)
+        print("{:>24}: {:8.1f}x".format("speedup", slow/fast))